@@ -8,34 +8,18 @@ import numpy as np
 import os
 os.environ['PYOPENCL_COMPILER_OUTPUT'] = '1'
 
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.buffer_pool import get_pool
+from common.cl_runtime import setup_CL
+from common.program_cache import build_kernel
+
 import matplotlib as mpl
 mpl.use('agg')
 import matplotlib.pyplot as plt
 
 import pdb
 
-def setup_CL():
-    """
-    Sets up openCL platform devices,
-        context, and CommandQueue
-
-    Returns: list of device, context, CommandQueue
-    """
-
-    #Set up openCL platform
-    NAME = 'NVIDIA CUDA'
-    platforms = cl.get_platforms()
-    dev = None
-    for p in platforms:
-        if p.name == NAME:
-            dev = p.get_devices()
-
-    # Command queue, enable GPU profiling
-    ctx = cl.Context(dev)
-    queue = cl.CommandQueue(ctx,properties=cl.command_queue_properties.PROFILING_ENABLE)
-
-    return [dev,ctx,queue]
-
 def simple_hash(name):
     """
     MultiIter openCL hash
@@ -47,6 +31,7 @@ def simple_hash(name):
 
     #Setup openCL
     dev, ctx, queue = setup_CL()
+    pool = get_pool(queue)
 
     #Ord(char) returns the ascii number for some character
     name = np.array([ord(char) for char in name]).astype(np.int32)
@@ -60,16 +45,13 @@ def simple_hash(name):
     """
 
     #Move data to device
-    mf = cl.mem_flags
-    name_dev = cl.Buffer(ctx, mf.READ_ONLY | mf.COPY_HOST_PTR, hostbuf=name)
-    b_dev = cl.Buffer(ctx, mf.WRITE_ONLY, name.nbytes)
-    # name_dev = cl.array.to_device(queue, name)
-    # b_dev = cl.array.empty(queue, name.shape, name.dtype)
+    name_dev = cl.array.to_device(queue, name, allocator=pool).data
+    b_dev = cl.array.empty(queue, name.shape, name.dtype, allocator=pool).data
 
     #Launch kernel
     #Only need global ID, no need for local
-    prg = cl.Program(ctx, kernel).build()
-    event = prg.func(queue, name.shape, None, name_dev, b_dev)
+    knl = build_kernel(ctx, kernel)
+    event = knl(queue, name.shape, None, name_dev, b_dev)
     event.wait()
     tmp = 1e-9*(event.profile.end-event.profile.start)
 
@@ -95,6 +77,7 @@ def multi_hash(name,iterCount):
 
     #Setup openCL
     dev, ctx, queue = setup_CL()
+    pool = get_pool(queue)
 
     #openCL Kernel
     kernel = """
@@ -117,21 +100,18 @@ def multi_hash(name,iterCount):
         name = np.array([ord(char) for char in refName]*(i+1)).astype(np.int32)
 
         #Move data to device
-        mf = cl.mem_flags
-        name_dev = cl.Buffer(ctx, mf.READ_ONLY | mf.COPY_HOST_PTR, hostbuf=name)
-        b_dev = cl.Buffer(ctx, mf.WRITE_ONLY, name.nbytes)
-        # name_dev = cl.array.to_device(queue, name)
-        # b_dev = cl.array.empty(queue, name.shape[0], name.dtype)
+        name_dev = cl.array.to_device(queue, name, allocator=pool).data
+        b_dev = cl.array.empty(queue, name.shape, name.dtype, allocator=pool).data
 
         #Launch kernel
         #Only need global ID, no need for local
-        prg = cl.Program(ctx, kernel).build()
+        knl = build_kernel(ctx, kernel)
 
 
         #Run event and get avg run time
         tmp = []
         for j in range(avgRunCount):
-            event = prg.func(queue, name.shape, None, name_dev, b_dev)
+            event = knl(queue, name.shape, None, name_dev, b_dev)
             event.wait()
             tmp.append(1e-9*(event.profile.end-event.profile.start))
         timeArray.append(np.average(tmp))
@@ -8,39 +8,19 @@ import numpy as np
 import os
 os.environ['PYOPENCL_COMPILER_OUTPUT'] = '1'
 
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.buffer_pool import get_pool
+from common.cl_runtime import setup_CL
+from common.program_cache import build_kernel, define_options
+
 import matplotlib as mpl
 mpl.use('agg')
 import matplotlib.pyplot as plt
 
 import pdb
 
-def setup_CL():
-    """
-    Sets up openCL platform devices,
-        context, and CommandQueue
-
-    Returns: list of device, context, CommandQueue
-    """
-
-    #Set up openCL platform
-    NAME = 'NVIDIA CUDA'
-    platforms = cl.get_platforms()
-
-    dev = None
-    for p in platforms:
-        #Easy switching for local vs remote machine
-        if p.name == 'Apple':
-            NAME = 'Apple'
-        if p.name == NAME:
-            dev = p.get_devices()
-
-    # Command queue, enable GPU profiling
-    ctx = cl.Context(dev)
-    queue = cl.CommandQueue(ctx,properties=cl.command_queue_properties.PROFILING_ENABLE)
-
-    return [dev,ctx,queue]
-
-def nonsquare_matrix_mult_opt2(matrix):
+def nonsquare_matrix_mult_opt2(matrix, specialize=False):
     """
     Transpose nonsquare matrix via openCL
     Multiply original by transpose
@@ -49,22 +29,31 @@ def nonsquare_matrix_mult_opt2(matrix):
     Measure runtime of transpose
     Input:
         variable matrix: numpy 2-d array
+        variable specialize: bake dims into the program (hot shapes) instead of
+                             passing them as kernel args (one program per sweep)
     Return/Output: [transposed matrix, runtime]
     """
 
     #Setup openCL
     dev, ctx, queue = setup_CL()
+    pool = get_pool(queue)
 
     #openCL Kernel
     #Naive approach with local/private memory
     #Naive approach reworked to use local memory and tiling
     #Modified boundary condition tiling kernel in lecture
-    kernel_code = """
-    #define MATRIX_ROW_SIZE {}
-    #define MATRIX_COL_SIZE {}
-    #define TILE_WIDTH {}
-    #define n {}
-    __kernel void func(__global float* a, __global float* b) {{
+    #Dims are kernel args unless specialized with -D build options
+    kernel = """
+    #ifndef MATRIX_ROW_SIZE
+    #define MATRIX_ROW_SIZE rows
+    #endif
+    #ifndef MATRIX_COL_SIZE
+    #define MATRIX_COL_SIZE cols
+    #endif
+    #ifndef MAX_DIM
+    #define MAX_DIM maxDim
+    #endif
+    __kernel void func(__global float* a, __global float* b, const int rows, const int cols, const int maxDim) {
 
         __local float M[TILE_WIDTH][TILE_WIDTH];
         __local float N[TILE_WIDTH][TILE_WIDTH];
@@ -76,67 +65,67 @@ def nonsquare_matrix_mult_opt2(matrix):
         float Cvalue = 0;
 
         // Loop over the A and B tiles required to compute the C element
-        for (int t = 0; t < (n-1)/TILE_WIDTH + 1;++t) {{
+        for (int t = 0; t < (MAX_DIM-1)/TILE_WIDTH + 1;++t) {
 
             //Assign rows of input
-            if(t*TILE_WIDTH+tx < MATRIX_COL_SIZE && tx < MATRIX_COL_SIZE && (Row*MATRIX_COL_SIZE + t*TILE_WIDTH + tx)<MATRIX_COL_SIZE*MATRIX_ROW_SIZE) {{
+            if(t*TILE_WIDTH+tx < MATRIX_COL_SIZE && tx < MATRIX_COL_SIZE && (Row*MATRIX_COL_SIZE + t*TILE_WIDTH + tx)<MATRIX_COL_SIZE*MATRIX_ROW_SIZE) {
                     M[ty][tx] = a[Row*MATRIX_COL_SIZE + t*TILE_WIDTH + tx];
-            }} else {{
+            } else {
                 M[ty][tx] = 0.0;
-            }}
+            }
 
             //Assign columns of transpose
-            if (t*TILE_WIDTH+ty < n && Col < MATRIX_ROW_SIZE) {{
+            if (t*TILE_WIDTH+ty < MAX_DIM && Col < MATRIX_ROW_SIZE) {
                 N[ty][tx] = a[t*TILE_WIDTH + MATRIX_COL_SIZE*Col + ty];
-            }} else {{
+            } else {
                 N[ty][tx] = 0.0;
-            }}
+            }
 
             barrier(CLK_LOCAL_MEM_FENCE);
 
             //Sum tile
-            for (int i = 0; i < TILE_WIDTH; ++i) {{
+            for (int i = 0; i < TILE_WIDTH; ++i) {
                 Cvalue += M[ty][i] * N[i][tx];
-            }}
+            }
 
             barrier(CLK_LOCAL_MEM_FENCE);
 
             //Assign values to output
-            if(Row<MATRIX_ROW_SIZE && Col<MATRIX_ROW_SIZE) {{
+            if(Row<MATRIX_ROW_SIZE && Col<MATRIX_ROW_SIZE) {
                 b[Row*MATRIX_ROW_SIZE + Col] = Cvalue;
 
-            }}
-        }}
-    }}
+            }
+        }
+    }
     """
 
     #Move data to device
     matrix_float = matrix.astype(np.float32)
-    matrix_gpu = cl.array.to_device(queue, matrix_float)
-    transposeMult_gpu = cl.array.empty(queue, (matrix.shape[0], matrix.shape[0]), np.float32)
-    transposed_gpu  = cl.array.empty(queue, (matrix.shape[1],matrix.shape[0]), np.float32)
+    matrix_gpu = cl.array.to_device(queue, matrix_float, allocator=pool)
+    transposeMult_gpu = cl.array.empty(queue, (matrix.shape[0], matrix.shape[0]), np.float32, allocator=pool)
+    transposed_gpu  = cl.array.empty(queue, (matrix.shape[1],matrix.shape[0]), np.float32, allocator=pool)
 
     matrix_row_size = matrix.shape[0]
     matrix_col_size = matrix.shape[1]
     TILE_WIDTH = 2
 
     #Calculate workItems, workGroup size, workGroups for input
-    matrix_val_count = matrix_float.shape[0]*matrix_float.shape[1]
     xWorkItems = int(int(matrix_row_size-1)/TILE_WIDTH)+1
     yWorkItems = int(int(matrix_row_size-1)/TILE_WIDTH)+1
-    totalWorkItems = float(TILE_WIDTH*TILE_WIDTH)
-    groups = np.int(max(np.ceil(matrix_val_count / xWorkItems),1))
 
-    # print("workItems: %s, matrix_val_count: %s, groups: %s" % (totalWorkItems, matrix_val_count, groups))
-
-    # update template with current runtime requirements
-    kernel = kernel_code.format(matrix_row_size, matrix_col_size, TILE_WIDTH, max(matrix_col_size, matrix_row_size))
+    # TILE_WIDTH sizes the local tiles so it is always a compile-time constant
+    # Hot shapes: also fold the current dims into the program
+    defines = {'TILE_WIDTH': TILE_WIDTH}
+    if specialize:
+        defines.update(MATRIX_ROW_SIZE=matrix_row_size, MATRIX_COL_SIZE=matrix_col_size,
+                       MAX_DIM=max(matrix_col_size, matrix_row_size))
 
     #Launch kernel and time it
     #Set global ID, workItems, workGroups
-    prg = cl.Program(ctx, kernel).build()
+    knl = build_kernel(ctx, kernel, define_options(**defines))
     start = time.time()
-    event = prg.func(queue, (xWorkItems*TILE_WIDTH,yWorkItems*TILE_WIDTH,1),(TILE_WIDTH,TILE_WIDTH,1), matrix_gpu.data, transposeMult_gpu.data)
+    event = knl(queue, (xWorkItems*TILE_WIDTH,yWorkItems*TILE_WIDTH,1),(TILE_WIDTH,TILE_WIDTH,1), matrix_gpu.data, transposeMult_gpu.data,
+                np.int32(matrix_row_size), np.int32(matrix_col_size), np.int32(max(matrix_col_size, matrix_row_size)))
     runtime = time.time()-start
 
     #Save output
@@ -171,6 +160,7 @@ def nonsquare_matrix_mult_opt1(matrix):
 
     #Setup openCL
     dev, ctx, queue = setup_CL()
+    pool = get_pool(queue)
 
     #openCL Kernel
     #Naive approach with local/private memory
@@ -221,9 +211,9 @@ def nonsquare_matrix_mult_opt1(matrix):
 
     #Move data to device
     matrix_float = matrix.astype(np.float32)
-    matrix_gpu = cl.array.to_device(queue, matrix_float)
-    transposeMult_gpu = cl.array.empty(queue, (matrix.shape[0], matrix.shape[0]), np.float32)
-    transposed_gpu  = cl.array.empty(queue, (matrix.shape[1],matrix.shape[0]), np.float32)
+    matrix_gpu = cl.array.to_device(queue, matrix_float, allocator=pool)
+    transposeMult_gpu = cl.array.empty(queue, (matrix.shape[0], matrix.shape[0]), np.float32, allocator=pool)
+    transposed_gpu  = cl.array.empty(queue, (matrix.shape[1],matrix.shape[0]), np.float32, allocator=pool)
 
     matrix_row_size = np.int32(matrix.shape[0])
     matrix_col_size = np.int32(matrix.shape[1])
@@ -245,9 +235,9 @@ def nonsquare_matrix_mult_opt1(matrix):
 
     #Launch kernel and time it
     #Set global ID, workItems, workGroups
-    prg = cl.Program(ctx, kernel).build()
+    knl = build_kernel(ctx, kernel)
     start = time.time()
-    event = prg.func(queue, (xWorkItems*yWorkItems,1),(groups,1), matrix_gpu.data, transposeMult_gpu.data, transposed_gpu.data)
+    event = knl(queue, (xWorkItems*yWorkItems,1),(groups,1), matrix_gpu.data, transposeMult_gpu.data, transposed_gpu.data)
 
     #event.wait()
     runtime = time.time()-start
@@ -282,6 +272,7 @@ def nonsquare_matrix_mult(matrix):
 
     #Setup openCL
     dev, ctx, queue = setup_CL()
+    pool = get_pool(queue)
 
     #openCL Kernel
     #Naive approach
@@ -325,9 +316,9 @@ def nonsquare_matrix_mult(matrix):
 
     #Move data to device
     matrix_float = matrix.astype(np.float32)
-    matrix_gpu = cl.array.to_device(queue, matrix_float)
-    transposeMult_gpu = cl.array.empty(queue, (matrix.shape[0], matrix.shape[0]), np.float32)
-    transposed_gpu  = cl.array.empty(queue, (matrix.shape[1],matrix.shape[0]), np.float32)
+    matrix_gpu = cl.array.to_device(queue, matrix_float, allocator=pool)
+    transposeMult_gpu = cl.array.empty(queue, (matrix.shape[0], matrix.shape[0]), np.float32, allocator=pool)
+    transposed_gpu  = cl.array.empty(queue, (matrix.shape[1],matrix.shape[0]), np.float32, allocator=pool)
 
     matrix_row_size = np.int32(matrix.shape[0])
     matrix_col_size = np.int32(matrix.shape[1])
@@ -349,9 +340,9 @@ def nonsquare_matrix_mult(matrix):
 
     #Launch kernel and time it
     #Set global ID, workItems, workGroups
-    prg = cl.Program(ctx, kernel).build()
+    knl = build_kernel(ctx, kernel)
     start = time.time()
-    event = prg.func(queue, (yWorkItems*xWorkItems,1),(groups,1), matrix_gpu.data, transposeMult_gpu.data, transposed_gpu.data)
+    event = knl(queue, (yWorkItems*xWorkItems,1),(groups,1), matrix_gpu.data, transposeMult_gpu.data, transposed_gpu.data)
 
     #event.wait()
     runtime = time.time()-start
@@ -385,6 +376,7 @@ def transpose_square_matrix(matrix):
 
     #Setup openCL
     dev, ctx, queue = setup_CL()
+    pool = get_pool(queue)
 
     #openCL Kernel
     kernel = """
@@ -396,8 +388,8 @@ def transpose_square_matrix(matrix):
 
     #Move data to device
     matrix_float = matrix.astype(np.float32)
-    matrix_gpu = cl.array.to_device(queue, matrix_float)
-    transpose_gpu = cl.array.empty(queue, matrix.shape, matrix_float.dtype)
+    matrix_gpu = cl.array.to_device(queue, matrix_float, allocator=pool)
+    transpose_gpu = cl.array.empty(queue, matrix.shape, matrix_float.dtype, allocator=pool)
 
     matrix_row_size = np.int32(matrix.shape[1])
 
@@ -413,9 +405,9 @@ def transpose_square_matrix(matrix):
 
     #Launch kernel and time it
     #Set global ID
-    prg = cl.Program(ctx, kernel).build()
+    knl = build_kernel(ctx, kernel)
     start = time.time()
-    event = prg.func(queue, (xWorkItems*xWorkItems,1),(groups,1), matrix_gpu.data, transpose_gpu.data, matrix_row_size)
+    event = knl(queue, (xWorkItems*xWorkItems,1),(groups,1), matrix_gpu.data, transpose_gpu.data, matrix_row_size)
     #event.wait()
     runtime = time.time()-start
     #Save output
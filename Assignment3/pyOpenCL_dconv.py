@@ -1,5 +1,8 @@
 import time
 import argparse
+import concurrent.futures
+import shutil
+import tempfile
 
 import pyopencl as cl
 import pyopencl.array
@@ -8,39 +11,100 @@ import numpy as np
 import os
 os.environ['PYOPENCL_COMPILER_OUTPUT'] = '1'
 
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.buffer_pool import get_pool
+from common.cl_runtime import setup_CL
+from common.program_cache import build_kernel, define_options
+
+# Optional openCL FFT (pyvkfft), dconv_fft falls back to numpy without it
+try:
+    import pyvkfft.fft as clfft
+except ImportError:
+    clfft = None
+
 import matplotlib as mpl
 mpl.use('agg')
 import matplotlib.pyplot as plt
 
 import pdb
 
-def setup_CL():
-    """
-    Sets up openCL platform devices,
-        context, and CommandQueue
-
-    Returns: list of device, context, CommandQueue
-    """
+# Engine picked by the last dconv_auto call, throughput of the last dconv_nchw call
+dconvStats = {}
 
-    #Set up openCL platform
-    NAME = 'NVIDIA CUDA'
-    platforms = cl.get_platforms()
+# dconv_auto cost model: one FFT unit (P*log2(P) over the padded size P)
+# costs FFT_COST_RATIO direct units (one filter tap at one pixel)
+FFT_COST_RATIO = 1.5
 
-    dev = None
-    for p in platforms:
-        #Easy switching for local vs remote machine
-        if p.name == 'Apple':
-            NAME = 'Apple'
-        if p.name == NAME:
-            dev = p.get_devices()
+# float64 FFT rounds back to exact integers while |output| stays below this
+FFT_EXACT_LIMIT = 2**40
 
-    # Command queue, enable GPU profiling
-    ctx = cl.Context(dev)
-    queue = cl.CommandQueue(ctx,properties=cl.command_queue_properties.PROFILING_ENABLE)
+# dconv accumulator/output types: name -> (openCL type, numpy dtype)
+ACC_TYPES = {'int32': ('int', np.int32), 'int64': ('long', np.int64), 'float32': ('float', np.float32)}
 
-    return [dev,ctx,queue]
+def dconvBound(matrix, filterVec, absMax=None):
+    """
+    Largest possible |output| of a dilated conv: sum(|filter|) * max(|input|)
+        -> one pass over the input (none if absMax is given), no convolution
+    Input:
+        variable absMax: precomputed max(|input|), see absMax()
+    Return/Output: python int
+    """
+    if not matrix.size:
+        return 0
+    if absMax is None:
+        absMax = _absMax(matrix)
+    return int(np.abs(np.asarray(filterVec)).astype(np.int64).sum()) * absMax
+
+def _absMax(matrix, chunkElements=2**22):
+    # max|x| in one read of the input: max and min of each row chunk while it
+    # is in cache, no full-size temporary for a (memmapped) input
+    if not matrix.size:
+        return 0
+    rowsPerChunk = int(max(1, chunkElements // max(1, matrix.size // matrix.shape[0])))
+    result = 0
+    for r in range(0, matrix.shape[0], rowsPerChunk):
+        chunk = np.asarray(matrix[r:r+rowsPerChunk])
+        result = max(result, int(chunk.max()), -int(chunk.min()))
+    return result
+
+def accumulatorType(matrix, filterVec, accType='auto', absMax=None):
+    """
+    Resolve the accumulator/output type of the direct dconv kernels
+        -> 'auto': narrowest integer type whose range holds dconvBound()
+           (int32, else int64)
+        -> 'int32', 'int64', 'float32': taken as given (float32 is exact
+           only below 2^24)
+    Input:
+        variable matrix: JxK numpy 2-d array of integer values
+        variable filterVec: Filter values
+        variable accType: 'auto' or a key of ACC_TYPES
+        variable absMax: precomputed max(|input|), saves the pass over the input
+    Return/Output: key of ACC_TYPES
+    """
+    if accType != 'auto':
+        if accType not in ACC_TYPES:
+            raise Exception('accType must be auto or one of {}, but get {}'.format(sorted(ACC_TYPES), accType))
+        return accType
+    return 'int32' if dconvBound(matrix, filterVec, absMax) <= np.iinfo(np.int32).max else 'int64'
 
-def dconv(matrix, filterVec, dDim):
+def _accumulatorOptions(matrix, filterVec, accType):
+    """
+    Build option and output dtype for the resolved accumulator type
+        -> at most one pass over the input, shared by the int32 check and
+           the 'auto' bound (none for an explicit type and an int32-safe dtype)
+    Return/Output: [options list, numpy dtype]
+    """
+    absMax = None
+    # Inputs and taps still travel as int32
+    if not np.can_cast(matrix.dtype, np.int32):
+        absMax = _absMax(matrix)
+        if absMax > np.iinfo(np.int32).max:
+            raise Exception('input values must fit int32')
+    clType, dtype = ACC_TYPES[accumulatorType(matrix, filterVec, accType, absMax)]
+    return [['-DACC_TYPE=%s' % clType], dtype]
+
+def dconv(matrix, filterVec, dDim, specialize=False, accType='auto'):
     """
     Calculate dilated conv of a MxN matrix
     Measure runtime of overall calculation
@@ -48,25 +112,41 @@ def dconv(matrix, filterVec, dDim):
         variable matrix: JxK numpy 2-d array of integer values
         variable filterVec: Filter values
         variable dDim: dilation coefficient
+        variable specialize: bake dims into the program (hot shapes) instead of
+                             passing them as kernel args (one program per sweep)
+        variable accType: accumulator/output type, see accumulatorType()
     Return/Output: [convolvedResult, runtime]
     """
 
     #Setup openCL
     dev, ctx, queue = setup_CL()
+    pool = get_pool(queue)
 
     #openCL Kernel
     #Dilated Convolution
-    kernel_code = """
-    #define MATRIX_ROW_SIZE {}
-    #define MATRIX_COL_SIZE {}
-    #define TILE_WIDTH {}
-    #define DDIM {}
-    #define KDIM {}
-    #define KDIM_EXP {}
-    #define KDIM_OFFSET {}
-    #define n {}
-
-    __kernel void func(__global int* input, __global int* kernelVals, __global int* convolved) {{
+    #Dims are kernel args unless specialized with -D build options
+    kernel = """
+    #ifndef MATRIX_ROW_SIZE
+    #define MATRIX_ROW_SIZE rows
+    #endif
+    #ifndef MATRIX_COL_SIZE
+    #define MATRIX_COL_SIZE cols
+    #endif
+    #ifndef DDIM
+    #define DDIM dDim
+    #endif
+    #ifndef KDIM
+    #define KDIM kDim
+    #endif
+    #ifndef KDIM_OFFSET
+    #define KDIM_OFFSET kOffset
+    #endif
+    #ifndef ACC_TYPE
+    #define ACC_TYPE int
+    #endif
+
+    __kernel void func(__global int* input, __global int* kernelVals, __global ACC_TYPE* convolved,
+                       const int rows, const int cols, const int dDim, const int kDim, const int kOffset) {
 
         //__shared__ float M[MATRIX_ROW_SIZE][1];
         //__shared__ float N[TILE_WIDTH][TILE_WIDTH];
@@ -75,62 +155,65 @@ def dconv(matrix, filterVec, dDim):
         int tx = get_local_id(0); int ty = get_local_id(1);
         int Row = by * get_local_size(1) + ty;
         int Col = bx * get_local_size(0) + tx;
-        int Cvalue = 0;
+        ACC_TYPE Cvalue = 0;
 
         // Calculate dilated convolution value for each thread
-        for (int t = 0; t < KDIM*KDIM;++t) {{
+        for (int t = 0; t < KDIM*KDIM;++t) {
 
             if((Row - KDIM_OFFSET + (t/KDIM)*DDIM) >= 0 && (Row - KDIM_OFFSET + (t/KDIM)*DDIM) < MATRIX_ROW_SIZE &&
                (Col - KDIM_OFFSET + (t%KDIM)*DDIM) >= 0 && (Col - KDIM_OFFSET + (t%KDIM)*DDIM) < MATRIX_COL_SIZE)
-            {{
-                Cvalue += kernelVals[t] * input[(Row - KDIM_OFFSET) * MATRIX_COL_SIZE + Col - KDIM_OFFSET + (t/KDIM)*DDIM * MATRIX_COL_SIZE + (t%KDIM)*DDIM];
+            {
+                Cvalue += (ACC_TYPE)kernelVals[t] * input[(Row - KDIM_OFFSET) * MATRIX_COL_SIZE + Col - KDIM_OFFSET + (t/KDIM)*DDIM * MATRIX_COL_SIZE + (t%KDIM)*DDIM];
                 //printf("A kernelVals[%d] = %d, input[%d] = %d, Row: %d, Col: %d\\n", t, kernelVals[t], ((Row - KDIM_OFFSET) * MATRIX_COL_SIZE + Col - KDIM_OFFSET + (t/KDIM)*DDIM * MATRIX_COL_SIZE + (t%KDIM)*DDIM), input[((Row - KDIM_OFFSET) * MATRIX_COL_SIZE + Col - KDIM_OFFSET + (t/KDIM)*DDIM * MATRIX_COL_SIZE + (t%KDIM)*DDIM)], Row, Col);
-            }}
-        }}
+            }
+        }
 
         barrier(CLK_LOCAL_MEM_FENCE);
 
         //Assign values to output
-        if(Row<MATRIX_ROW_SIZE && Col < MATRIX_COL_SIZE) {{
+        if(Row<MATRIX_ROW_SIZE && Col < MATRIX_COL_SIZE) {
             convolved[Row*MATRIX_COL_SIZE + Col] = Cvalue;
             //printf("Cvalue = %d, loc = %d, Row: %d, Col: %d\\n", Cvalue, (Row*MATRIX_COL_SIZE + Col), Row, Col);
-        }}
-    }}
+        }
+    }
     """
 
     #Move data to device
     matrix_int = matrix.astype(np.int32)
-    matrix_gpu = cl.array.to_device(queue, matrix_int)
-    filterVec_int = filterVec.astype(np.int32)
-    filterVec_gpu = cl.array.to_device(queue, filterVec_int)
-    convolved = cl.array.empty(queue, (matrix.shape[0], matrix.shape[1]), np.int32)
+    matrix_gpu = cl.array.to_device(queue, matrix_int, allocator=pool)
+    filterVec_int = np.asarray(filterVec).astype(np.int32)
+    filterVec_gpu = cl.array.to_device(queue, filterVec_int, allocator=pool)
+    accOptions, accDtype = _accumulatorOptions(matrix, filterVec, accType)
+    convolved = cl.array.empty(queue, (matrix.shape[0], matrix.shape[1]), accDtype, allocator=pool)
 
     # Pre-calculate values used across all threads
     matrix_row_size = matrix.shape[0]
     matrix_col_size = matrix.shape[1]
 
+    kernelDim = int(np.sqrt(len(filterVec)))
     kernelExpandedDim = int((dDim-1)*(np.sqrt(len(filterVec))-1)+np.sqrt(len(filterVec))) # Expanded Size
     dconv_offset = int(kernelExpandedDim/2) # value used to center input matrix on kernel
 
     TILE_WIDTH = 32
 
     #Calculate workItems, workGroup size, workGroups for input
-    matrix_val_count = matrix_int.shape[0]*matrix_int.shape[1]
     xWorkItems = int(int(matrix_col_size-1)/TILE_WIDTH)+1
     yWorkItems = int(int(matrix_row_size-1)/TILE_WIDTH)+1
-    totalWorkItems = float(TILE_WIDTH*TILE_WIDTH)
-    groups = np.int(max(np.ceil(matrix_val_count / xWorkItems),1))
 
-    # print("workItems: %s, matrix_val_count: %s, groups: %s" % (totalWorkItems, matrix_val_count, groups))
-
-    # update template with current runtime requirements
-    kernel = kernel_code.format(matrix_row_size, matrix_col_size, TILE_WIDTH, dDim, int(np.sqrt(len(filterVec))),kernelExpandedDim,dconv_offset,max(matrix_col_size, matrix_row_size))
+    # Hot shapes: fold the current dims into the program as constants
+    options = []
+    if specialize:
+        options = define_options(MATRIX_ROW_SIZE=matrix_row_size, MATRIX_COL_SIZE=matrix_col_size,
+                                 DDIM=dDim, KDIM=kernelDim, KDIM_OFFSET=dconv_offset)
 
     #Launch kernel and time it
     #Set global ID, workItems, workGroups
-    prg = cl.Program(ctx, kernel).build()
+    knl = build_kernel(ctx, kernel, options + accOptions)
     start = time.time()
-    event = prg.func(queue, (xWorkItems*TILE_WIDTH,yWorkItems*TILE_WIDTH,1),(TILE_WIDTH,TILE_WIDTH,1), matrix_gpu.data, filterVec_gpu.data, convolved.data)
+    event = knl(queue, (xWorkItems*TILE_WIDTH,yWorkItems*TILE_WIDTH,1),(TILE_WIDTH,TILE_WIDTH,1),
+                matrix_gpu.data, filterVec_gpu.data, convolved.data,
+                np.int32(matrix_row_size), np.int32(matrix_col_size), np.int32(dDim),
+                np.int32(kernelDim), np.int32(dconv_offset))
     runtime = time.time()-start
 
     #Save output
@@ -150,6 +233,765 @@ def dconv(matrix, filterVec, dDim):
 
     return [convolvedResult, runtime]
 
+def dconv_tiled(matrix, filterVec, dDim, tileWidth=16, accType='auto'):
+    """
+    Calculate dilated conv of a MxN matrix with local-memory tiles
+        -> each work-group loads its TILE_WIDTH x TILE_WIDTH outputs plus the
+           dilated halo (KDIM-1)*DDIM into local memory once, zero-filled
+           outside the image
+        -> branch-free inner loop over KDIM*KDIM taps, filter in constant memory
+        -> halo too large for local memory (big dilations) -> falls back to dconv()
+    Input:
+        variable matrix: JxK numpy 2-d array of integer values
+        variable filterVec: Filter values
+        variable dDim: dilation coefficient
+        variable tileWidth: output tile side per work-group
+        variable accType: accumulator/output type, see accumulatorType()
+    Return/Output: [convolvedResult, runtime]
+    """
+
+    #Setup openCL
+    dev, ctx, queue = setup_CL()
+    pool = get_pool(queue)
+
+    #openCL Kernel
+    #Tiled Dilated Convolution
+    kernel = """
+    #ifndef ACC_TYPE
+    #define ACC_TYPE int
+    #endif
+
+    __kernel void func(__global const int* input, __constant int* kernelVals, __global ACC_TYPE* convolved,
+                       __local int* tile, const int rows, const int cols, const int dDim,
+                       const int kDim, const int kOffset, const int pitch) {
+
+        int tx = get_local_id(0); int ty = get_local_id(1);
+        int lsize = get_local_size(0) * get_local_size(1);
+        int Row = get_global_id(1);
+        int Col = get_global_id(0);
+
+        //Top-left input pixel of this group's tile, halo included
+        int rowStart = get_group_id(1) * get_local_size(1) - kOffset;
+        int colStart = get_group_id(0) * get_local_size(0) - kOffset;
+
+        //Cooperative load, zero outside the image
+        for (int idx = ty * get_local_size(0) + tx; idx < pitch * pitch; idx += lsize) {
+            int r = rowStart + idx / pitch;
+            int c = colStart + idx % pitch;
+            tile[idx] = (r >= 0 && r < rows && c >= 0 && c < cols) ? input[r * cols + c] : 0;
+        }
+        barrier(CLK_LOCAL_MEM_FENCE);
+
+        // Calculate dilated convolution value for each thread
+        ACC_TYPE Cvalue = 0;
+        for (int k = 0; k < kDim; ++k) {
+            __local const int* tileRow = tile + (ty + k * dDim) * pitch + tx;
+            for (int m = 0; m < kDim; ++m) {
+                Cvalue += (ACC_TYPE)kernelVals[k * kDim + m] * tileRow[m * dDim];
+            }
+        }
+
+        //Assign values to output
+        if (Row < rows && Col < cols) {
+            convolved[Row * cols + Col] = Cvalue;
+        }
+    }
+    """
+
+    # Pre-calculate values used across all threads
+    matrix_row_size = matrix.shape[0]
+    matrix_col_size = matrix.shape[1]
+
+    kernelDim = int(np.sqrt(len(filterVec)))
+    kernelExpandedDim = (dDim-1)*(kernelDim-1)+kernelDim # Expanded Size
+    dconv_offset = int(kernelExpandedDim/2) # value used to center input matrix on kernel
+
+    # Tile plus halo must fit in local memory (keep half free for the runtime)
+    TILE_WIDTH = int(min(tileWidth, int(np.sqrt(dev[0].max_work_group_size))))
+    pitch = TILE_WIDTH + (kernelDim-1)*dDim
+    tileBytes = pitch * pitch * np.dtype(np.int32).itemsize
+    if tileBytes > dev[0].local_mem_size // 2:
+        return dconv(matrix, filterVec, dDim, accType=accType)
+
+    #Move data to device
+    matrix_gpu = cl.array.to_device(queue, np.ascontiguousarray(matrix, dtype=np.int32), allocator=pool)
+    filterVec_gpu = cl.array.to_device(queue, np.asarray(filterVec).astype(np.int32), allocator=pool)
+    accOptions, accDtype = _accumulatorOptions(matrix, filterVec, accType)
+    convolved = cl.array.empty(queue, (matrix_row_size, matrix_col_size), accDtype, allocator=pool)
+
+    #Calculate workItems, workGroup size, workGroups for input
+    xWorkItems = int(int(matrix_col_size-1)/TILE_WIDTH)+1
+    yWorkItems = int(int(matrix_row_size-1)/TILE_WIDTH)+1
+
+    #Launch kernel and time it
+    #Set global ID, workItems, workGroups
+    knl = build_kernel(ctx, kernel, accOptions)
+    start = time.time()
+    event = knl(queue, (xWorkItems*TILE_WIDTH, yWorkItems*TILE_WIDTH), (TILE_WIDTH, TILE_WIDTH),
+                matrix_gpu.data, filterVec_gpu.data, convolved.data, cl.LocalMemory(tileBytes),
+                np.int32(matrix_row_size), np.int32(matrix_col_size), np.int32(dDim),
+                np.int32(kernelDim), np.int32(dconv_offset), np.int32(pitch))
+    event.wait()
+    runtime = time.time()-start
+
+    #Save output
+    convolvedResult = convolved.get()
+
+    return [convolvedResult, runtime]
+
+def _fftLen(n):
+    """
+    Smallest 2^a 3^b 5^c >= n, FFT sizes numpy/vkFFT handle fastest
+    """
+    best = None
+    p2 = 1
+    while p2 < 2*n:
+        p3 = p2
+        while p3 < 2*n:
+            p5 = p3
+            while p5 < n:
+                p5 *= 5
+            best = p5 if best is None else min(best, p5)
+            p3 *= 3
+        p2 *= 2
+    return best
+
+def _fftOperands(matrix, filterVec, dDim):
+    """
+    Zero-padded input and flipped expanded kernel for FFT correlation
+    Input:
+        variable matrix: JxK numpy 2-d array of integer values
+        variable filterVec: Filter values
+        variable dDim: dilation coefficient
+    Return/Output: [padded input shape, expanded kernel, crop offset]
+    """
+
+    # Expanded kernel, filterVec scattered every dDim as in python_dconv_verify
+    kernelDim = int(np.sqrt(len(filterVec)))
+    correlationDim = (dDim-1)*(kernelDim-1)+kernelDim
+    dconv_offset = int(correlationDim/2) # value used to center input matrix on kernel
+    dconv_kernel = np.zeros([correlationDim, correlationDim])
+    dconv_kernel[::dDim, ::dDim] = np.asarray(filterVec).reshape(kernelDim, kernelDim)
+
+    # Linear (not circular) correlation: pad to input + kernel - 1, fast FFT length
+    shape = (_fftLen(matrix.shape[0] + correlationDim - 1), _fftLen(matrix.shape[1] + correlationDim - 1))
+
+    # Correlation = convolution with the flipped kernel, output shifted by the flip
+    return [shape, dconv_kernel[::-1, ::-1], correlationDim - 1 - dconv_offset]
+
+def python_dconv_fft(matrix, filterVec, dDim):
+    """
+    Calculate dilated conv of a MxN matrix with numpy FFTs
+        -> O(P log P) on the padded size P, independent of KDIM and dDim
+        -> products rounded back to exact integers (int64)
+    Input:
+        variable matrix: JxK numpy 2-d array of integer values
+        variable filterVec: Filter values
+        variable dDim: dilation coefficient
+    Return/Output: [convolved, runtime]
+    """
+
+    start = time.time()
+    shape, flipped, crop = _fftOperands(matrix, filterVec, dDim)
+    full = np.fft.irfft2(np.fft.rfft2(matrix, shape) * np.fft.rfft2(flipped, shape), shape)
+    output = np.rint(full[crop:crop+matrix.shape[0], crop:crop+matrix.shape[1]]).astype(np.int64)
+    end = time.time()-start
+    return [output, end]
+
+def dconv_fft(matrix, filterVec, dDim):
+    """
+    Calculate dilated conv of a MxN matrix with openCL FFTs (pyvkfft)
+        -> complex128 transforms, products rounded back to exact integers
+        -> no pyvkfft or no fp64 on the device -> python_dconv_fft()
+    Input:
+        variable matrix: JxK numpy 2-d array of integer values
+        variable filterVec: Filter values
+        variable dDim: dilation coefficient
+    Return/Output: [convolved, runtime]
+    """
+
+    #Setup openCL
+    dev, ctx, queue = setup_CL()
+    if clfft is None or not dev[0].double_fp_config:
+        return python_dconv_fft(matrix, filterVec, dDim)
+    pool = get_pool(queue)
+
+    shape, flipped, crop = _fftOperands(matrix, filterVec, dDim)
+    matrix_pad = np.zeros(shape, dtype=np.complex128)
+    matrix_pad[:matrix.shape[0], :matrix.shape[1]] = matrix
+    kernel_pad = np.zeros(shape, dtype=np.complex128)
+    kernel_pad[:flipped.shape[0], :flipped.shape[1]] = flipped
+
+    #Move data to device, transform, multiply, transform back
+    start = time.time()
+    matrix_gpu = cl.array.to_device(queue, matrix_pad, allocator=pool)
+    kernel_gpu = cl.array.to_device(queue, kernel_pad, allocator=pool)
+    full = clfft.ifftn(clfft.fftn(matrix_gpu) * clfft.fftn(kernel_gpu)).get()
+    runtime = time.time()-start
+
+    #Save output
+    convolvedResult = np.rint(full.real[crop:crop+matrix.shape[0], crop:crop+matrix.shape[1]]).astype(np.int64)
+    return [convolvedResult, runtime]
+
+def separableFilter(filterVec):
+    """
+    Exact integer rank-1 factorization of the KDIMxKDIM filter
+        -> filter == outer(colTaps, rowTaps) with integer taps, or None
+        -> rowTaps is a primitive row (gcd 1), so colTaps are integers
+    Input:
+        variable filterVec: Filter values
+    Return/Output: [colTaps, rowTaps] int64 vectors, or None if not separable
+    """
+    kernelDim = int(np.sqrt(len(filterVec)))
+    taps = np.asarray(filterVec).astype(np.int64).reshape(kernelDim, kernelDim)
+    nonzero = np.flatnonzero(np.any(taps != 0, axis=1))
+    if len(nonzero) == 0:
+        return [np.zeros(kernelDim, dtype=np.int64), np.zeros(kernelDim, dtype=np.int64)]
+
+    # Primitive version of the first nonzero row
+    rowTaps = taps[nonzero[0]]
+    rowTaps = rowTaps // np.gcd.reduce(np.abs(rowTaps))
+    pivot = np.flatnonzero(rowTaps)[0]
+
+    # Every row must be an integer multiple of rowTaps
+    colTaps = taps[:, pivot] // rowTaps[pivot]
+    if not np.array_equal(np.outer(colTaps, rowTaps), taps):
+        return None
+    return [colTaps, rowTaps]
+
+def python_dconv_separable(matrix, filterVec, dDim):
+    """
+    Calculate dilated conv of a MxN matrix as two 1-d dilated passes
+        -> rank-1 integer filters: rows then columns, 2*KDIM taps per pixel
+           instead of KDIM*KDIM
+        -> other filters fall through to python_dconv_vectorized()
+    Input:
+        variable matrix: JxK numpy 2-d array of integer values
+        variable filterVec: Filter values
+        variable dDim: dilation coefficient
+    Return/Output: [convolved, runtime]
+    """
+    factors = separableFilter(filterVec)
+    if factors is None:
+        return python_dconv_vectorized(matrix, filterVec, dDim)
+    colTaps, rowTaps = factors
+
+    kernelDim = len(rowTaps)
+    correlationDim = (dDim-1)*(kernelDim-1)+kernelDim
+    dconv_offset = int(correlationDim/2) # value used to center input matrix on kernel
+    rows, cols = matrix.shape
+
+    start = time.time()
+
+    # Row pass over a column-padded input
+    padded = np.zeros([rows, cols + correlationDim - 1], dtype=np.int64)
+    padded[:, dconv_offset:dconv_offset+cols] = matrix
+    rowPass = np.zeros([rows + correlationDim - 1, cols], dtype=np.int64)
+    for m in range(kernelDim):
+        if rowTaps[m]:
+            rowPass[dconv_offset:dconv_offset+rows] += rowTaps[m] * padded[:, m*dDim:m*dDim+cols]
+
+    # Column pass over the row-padded row pass
+    output = np.zeros([rows, cols], dtype=np.int64)
+    for k in range(kernelDim):
+        if colTaps[k]:
+            output += colTaps[k] * rowPass[k*dDim:k*dDim+rows]
+
+    end = time.time()-start
+    return [output, end]
+
+def dconv_separable(matrix, filterVec, dDim, accType='auto'):
+    """
+    Calculate dilated conv of a MxN matrix as two 1-d dilated openCL passes
+        -> rank-1 integer filters: row pass then column pass kernel,
+           2*KDIM taps per pixel instead of KDIM*KDIM
+        -> row pass kept in the accumulator type, its bound is at most
+           the full filter's
+        -> other filters fall through to dconv()
+    Input:
+        variable matrix: JxK numpy 2-d array of integer values
+        variable filterVec: Filter values
+        variable dDim: dilation coefficient
+        variable accType: accumulator/output type, see accumulatorType()
+    Return/Output: [convolvedResult, runtime]
+    """
+    factors = separableFilter(filterVec)
+    if factors is None:
+        return dconv(matrix, filterVec, dDim, accType=accType)
+    colTaps, rowTaps = factors
+
+    #Setup openCL
+    dev, ctx, queue = setup_CL()
+    pool = get_pool(queue)
+
+    #openCL Kernel
+    #1-d dilated passes, step is 1 for the row pass and cols for the column pass
+    #INPUT_TYPE is int for the row pass and ACC_TYPE for the column pass
+    kernel = """
+    #ifndef ACC_TYPE
+    #define ACC_TYPE int
+    #endif
+    #ifndef INPUT_TYPE
+    #define INPUT_TYPE int
+    #endif
+
+    __kernel void func(__global const INPUT_TYPE* input, __constant int* taps, __global ACC_TYPE* output,
+                       const int rows, const int cols, const int dDim, const int kDim,
+                       const int kOffset, const int alongRows) {
+        int Col = get_global_id(0);
+        int Row = get_global_id(1);
+        if (Row >= rows || Col >= cols) return;
+
+        int pos = alongRows ? Row : Col;
+        int size = alongRows ? rows : cols;
+        int step = alongRows ? cols : 1;
+        __global const INPUT_TYPE* center = input + Row * cols + Col;
+
+        ACC_TYPE Cvalue = 0;
+        for (int t = 0; t < kDim; ++t) {
+            int shift = t * dDim - kOffset;
+            if (pos + shift >= 0 && pos + shift < size) {
+                Cvalue += (ACC_TYPE)taps[t] * center[shift * step];
+            }
+        }
+        output[Row * cols + Col] = Cvalue;
+    }
+    """
+
+    # Pre-calculate values used across all threads
+    matrix_row_size = matrix.shape[0]
+    matrix_col_size = matrix.shape[1]
+    kernelDim = len(rowTaps)
+    kernelExpandedDim = (dDim-1)*(kernelDim-1)+kernelDim # Expanded Size
+    dconv_offset = int(kernelExpandedDim/2) # value used to center input matrix on kernel
+    accOptions, accDtype = _accumulatorOptions(matrix, filterVec, accType)
+
+    #Move data to device
+    matrix_gpu = cl.array.to_device(queue, np.ascontiguousarray(matrix, dtype=np.int32), allocator=pool)
+    rowTaps_gpu = cl.array.to_device(queue, rowTaps.astype(np.int32), allocator=pool)
+    colTaps_gpu = cl.array.to_device(queue, colTaps.astype(np.int32), allocator=pool)
+    rowPass = cl.array.empty(queue, (matrix_row_size, matrix_col_size), accDtype, allocator=pool)
+    convolved = cl.array.empty(queue, (matrix_row_size, matrix_col_size), accDtype, allocator=pool)
+
+    #Launch kernels and time them
+    rowKnl = build_kernel(ctx, kernel, accOptions)
+    colKnl = build_kernel(ctx, kernel, accOptions + [accOptions[0].replace('ACC_TYPE', 'INPUT_TYPE')])
+    args = (np.int32(matrix_row_size), np.int32(matrix_col_size), np.int32(dDim),
+            np.int32(kernelDim), np.int32(dconv_offset))
+    start = time.time()
+    rowKnl(queue, (matrix_col_size, matrix_row_size), None, matrix_gpu.data, rowTaps_gpu.data, rowPass.data, *(args + (np.int32(0),)))
+    event = colKnl(queue, (matrix_col_size, matrix_row_size), None, rowPass.data, colTaps_gpu.data, convolved.data, *(args + (np.int32(1),)))
+    event.wait()
+    runtime = time.time()-start
+
+    #Save output
+    convolvedResult = convolved.get()
+
+    return [convolvedResult, runtime]
+
+def dconv_batched(matrix, filterBank, dDims, accType='auto'):
+    """
+    Calculate dilated convs of one MxN matrix with a bank of filters
+        -> input uploaded once, one launch covers the whole bank (filter index
+           on the third grid dimension)
+        -> taps, dilations and offsets of every filter in constant memory,
+           banks beyond the constant buffer limit run in a few launches
+    Input:
+        variable matrix: JxK numpy 2-d array of integer values
+        variable filterBank: (F, KDIM, KDIM) filter values
+        variable dDims: dilation coefficient, one for all filters or one per filter
+        variable accType: accumulator/output type, see accumulatorType(), sized for the largest filter
+    Return/Output: [convolvedResult (F, J, K), runtime]
+    """
+
+    #Setup openCL
+    dev, ctx, queue = setup_CL()
+    pool = get_pool(queue)
+
+    #openCL Kernel
+    #Batched Dilated Convolution
+    kernel = """
+    #ifndef ACC_TYPE
+    #define ACC_TYPE int
+    #endif
+
+    __kernel void func(__global const int* input, __constant int* kernelVals, __constant int* dDims,
+                       __constant int* kOffsets, __global ACC_TYPE* convolved,
+                       const int rows, const int cols, const int kDim, const int firstFilter) {
+
+        int Col = get_global_id(0);
+        int Row = get_global_id(1);
+        int f = get_global_id(2);
+        if (Row >= rows || Col >= cols) return;
+
+        int dDim = dDims[f];
+        int kOffset = kOffsets[f];
+        __constant int* taps = kernelVals + f * kDim * kDim;
+
+        // Calculate dilated convolution value for each thread
+        ACC_TYPE Cvalue = 0;
+        for (int k = 0; k < kDim; ++k) {
+            int r = Row - kOffset + k * dDim;
+            if (r < 0 || r >= rows) continue;
+            for (int m = 0; m < kDim; ++m) {
+                int c = Col - kOffset + m * dDim;
+                if (c >= 0 && c < cols) {
+                    Cvalue += (ACC_TYPE)taps[k * kDim + m] * input[r * cols + c];
+                }
+            }
+        }
+
+        //Assign values to output
+        convolved[((size_t)(firstFilter + f) * rows + Row) * cols + Col] = Cvalue;
+    }
+    """
+
+    # Pre-calculate values used across all threads
+    filterBank = np.asarray(filterBank).astype(np.int32)
+    if filterBank.ndim != 3 or filterBank.shape[1] != filterBank.shape[2]:
+        raise Exception('filterBank must be (F, KDIM, KDIM), but get {}'.format(filterBank.shape))
+    numFilters, kernelDim = filterBank.shape[0], filterBank.shape[1]
+    dDims = np.broadcast_to(np.asarray(dDims, dtype=np.int32), (numFilters,)).copy()
+    kernelExpandedDims = (dDims-1)*(kernelDim-1)+kernelDim # Expanded Size
+    dconv_offsets = (kernelExpandedDims//2).astype(np.int32) # value used to center input matrix on kernel
+    matrix_row_size = matrix.shape[0]
+    matrix_col_size = matrix.shape[1]
+    # The filter with the largest sum(|taps|) bounds the whole bank
+    widest = np.abs(filterBank.astype(np.int64)).reshape(numFilters, -1).sum(axis=1).argmax() if numFilters else 0
+    accOptions, accDtype = _accumulatorOptions(matrix, filterBank[widest:widest+1].reshape(-1), accType)
+    if numFilters == 0:
+        # Empty bank, nothing to launch
+        return [np.zeros((0, matrix_row_size, matrix_col_size), dtype=accDtype), 0.0]
+
+    # Filters per launch: taps, dilation and offset must fit in constant memory
+    perFilterBytes = (kernelDim*kernelDim + 2) * np.dtype(np.int32).itemsize
+    chunk = int(max(1, min(numFilters, dev[0].max_constant_buffer_size // perFilterBytes)))
+
+    #Move data to device
+    matrix_gpu = cl.array.to_device(queue, np.ascontiguousarray(matrix, dtype=np.int32), allocator=pool)
+    convolved = cl.array.empty(queue, (numFilters, matrix_row_size, matrix_col_size), accDtype, allocator=pool)
+
+    #Launch kernel and time it
+    knl = build_kernel(ctx, kernel, accOptions)
+    start = time.time()
+    for first in range(0, numFilters, chunk):
+        last = min(first + chunk, numFilters)
+        taps_gpu = cl.array.to_device(queue, filterBank[first:last].reshape(-1), allocator=pool)
+        dDims_gpu = cl.array.to_device(queue, dDims[first:last], allocator=pool)
+        offsets_gpu = cl.array.to_device(queue, dconv_offsets[first:last], allocator=pool)
+        event = knl(queue, (matrix_col_size, matrix_row_size, last - first), None,
+                    matrix_gpu.data, taps_gpu.data, dDims_gpu.data, offsets_gpu.data, convolved.data,
+                    np.int32(matrix_row_size), np.int32(matrix_col_size), np.int32(kernelDim), np.int32(first))
+    event.wait()
+    runtime = time.time()-start
+
+    #Save output
+    convolvedResult = convolved.get()
+
+    return [convolvedResult, runtime]
+
+def _channelFilters(filters, channels):
+    """
+    (C, KDIM, KDIM) int32 filters, a single (KDIM, KDIM) filter is shared by all channels
+    """
+    filters = np.asarray(filters).astype(np.int32)
+    if filters.ndim == 2:
+        filters = np.broadcast_to(filters, (channels,) + filters.shape)
+    if filters.ndim != 3 or filters.shape[0] != channels or filters.shape[1] != filters.shape[2]:
+        raise Exception('filters must be (KDIM, KDIM) or ({}, KDIM, KDIM), but get {}'.format(channels, filters.shape))
+    return np.ascontiguousarray(filters)
+
+def dconv_nchw(images, filters, dDim, sumChannels=False, accType='auto'):
+    """
+    Calculate dilated convs of a (N, C, H, W) stack of images in one launch
+        -> image (and channel) index on the third grid dimension
+        -> per-channel: channel c convolved with filters[c], (N, C, H, W) out
+        -> sumChannels: per-channel results summed, (N, H, W) out
+        -> throughput in dconvStats['images_per_sec']
+    Input:
+        variable images: (N, C, H, W) numpy array of integer values
+        variable filters: (C, KDIM, KDIM) per-channel filters or one (KDIM, KDIM) filter
+        variable dDim: dilation coefficient
+        variable sumChannels: sum over channels instead of one output per channel
+        variable accType: accumulator/output type, see accumulatorType(), summed
+                          outputs are bounded over all channel filters
+    Return/Output: [convolvedResult, runtime]
+    """
+
+    #Setup openCL
+    dev, ctx, queue = setup_CL()
+    pool = get_pool(queue)
+
+    #openCL Kernel
+    #Multi-channel Dilated Convolution
+    kernel = """
+    #ifndef ACC_TYPE
+    #define ACC_TYPE int
+    #endif
+
+    __kernel void func(__global const int* input, __constant int* kernelVals, __global ACC_TYPE* convolved,
+                       const int channels, const int rows, const int cols, const int dDim,
+                       const int kDim, const int kOffset, const int sumChannels) {
+
+        int Col = get_global_id(0);
+        int Row = get_global_id(1);
+        int z = get_global_id(2);
+        if (Row >= rows || Col >= cols) return;
+
+        //z is an image (summed) or an (image, channel) plane
+        int n = sumChannels ? z : z / channels;
+        int cStart = sumChannels ? 0 : z % channels;
+        int cStop = sumChannels ? channels : cStart + 1;
+
+        // Calculate dilated convolution value for each thread
+        ACC_TYPE Cvalue = 0;
+        for (int c = cStart; c < cStop; ++c) {
+            __global const int* plane = input + (size_t)(n * channels + c) * rows * cols;
+            __constant int* taps = kernelVals + c * kDim * kDim;
+            for (int k = 0; k < kDim; ++k) {
+                int r = Row - kOffset + k * dDim;
+                if (r < 0 || r >= rows) continue;
+                for (int m = 0; m < kDim; ++m) {
+                    int col = Col - kOffset + m * dDim;
+                    if (col >= 0 && col < cols) {
+                        Cvalue += (ACC_TYPE)taps[k * kDim + m] * plane[r * cols + col];
+                    }
+                }
+            }
+        }
+
+        //Assign values to output
+        convolved[((size_t)z * rows + Row) * cols + Col] = Cvalue;
+    }
+    """
+
+    # Pre-calculate values used across all threads
+    if images.ndim != 4:
+        raise Exception('images must be (N, C, H, W), but get {}'.format(images.shape))
+    N, C, rows, cols = images.shape
+    filters = _channelFilters(filters, C)
+    kernelDim = filters.shape[1]
+    kernelExpandedDim = (dDim-1)*(kernelDim-1)+kernelDim # Expanded Size
+    dconv_offset = int(kernelExpandedDim/2) # value used to center input matrix on kernel
+    planes = N if sumChannels else N*C
+    outShape = (N, rows, cols) if sumChannels else (N, C, rows, cols)
+    if sumChannels:
+        boundTaps = filters.reshape(-1)
+    else:
+        widest = np.abs(filters.astype(np.int64)).reshape(C, -1).sum(axis=1).argmax() if C else 0
+        boundTaps = filters[widest:widest+1].reshape(-1)
+    accOptions, accDtype = _accumulatorOptions(images, boundTaps, accType)
+
+    #Move data to device
+    images_gpu = cl.array.to_device(queue, np.ascontiguousarray(images, dtype=np.int32), allocator=pool)
+    filters_gpu = cl.array.to_device(queue, filters.reshape(-1), allocator=pool)
+    convolved = cl.array.empty(queue, outShape, accDtype, allocator=pool)
+
+    #Launch kernel and time it
+    knl = build_kernel(ctx, kernel, accOptions)
+    start = time.time()
+    event = knl(queue, (cols, rows, planes), None, images_gpu.data, filters_gpu.data, convolved.data,
+                np.int32(C), np.int32(rows), np.int32(cols), np.int32(dDim),
+                np.int32(kernelDim), np.int32(dconv_offset), np.int32(bool(sumChannels)))
+    event.wait()
+    runtime = time.time()-start
+    dconvStats['images_per_sec'] = N / runtime if runtime > 0 else float('inf')
+
+    #Save output
+    convolvedResult = convolved.get()
+
+    return [convolvedResult, runtime]
+
+def dconv_stream(matrix, filterVec, dDim, out=None, bandBytes=2**26, accType='auto'):
+    """
+    Calculate dilated conv of a MxN matrix too large for host or device memory
+        -> row bands of the (memmapped) input, each with the dilated halo:
+           KDIM_OFFSET rows above, the rest of the expanded kernel below
+        -> next band read from disk and previous result written to the output
+           memmap on worker threads while the device computes the current band
+        -> device memory bounded by bandBytes, host memory by a few bands only
+           when out is a memmap (or a path), out=None holds the whole output
+        -> output equal to dconv() with the same accType
+    Input:
+        variable matrix: JxK numpy 2-d array (np.memmap) of integer values
+        variable filterVec: Filter values
+        variable dDim: dilation coefficient
+        variable out: JxK output array/memmap of the accumulator dtype or a file path
+                      for a new memmap (None -> in memory)
+        variable bandBytes: target size of one input band on the device, must hold
+                            one row plus the dilated halo
+        variable accType: accumulator/output type, see accumulatorType()
+    Return/Output: [convolvedResult, runtime]
+    """
+
+    #Setup openCL
+    dev, ctx, queue = setup_CL()
+    pool = get_pool(queue)
+
+    #openCL Kernel
+    #Dilated Convolution of one band, rows outside the image read as zero
+    kernel = """
+    #ifndef ACC_TYPE
+    #define ACC_TYPE int
+    #endif
+
+    __kernel void func(__global const int* input, __constant int* kernelVals, __global ACC_TYPE* convolved,
+                       const int rows, const int cols, const int dDim, const int kDim, const int kOffset,
+                       const int bandStart, const int bandRows, const int inputStart) {
+
+        int Col = get_global_id(0);
+        int Row = get_global_id(1);
+        if (Row >= bandRows || Col >= cols) return;
+        int imageRow = bandStart + Row;
+
+        // Calculate dilated convolution value for each thread
+        ACC_TYPE Cvalue = 0;
+        for (int k = 0; k < kDim; ++k) {
+            int r = imageRow - kOffset + k * dDim;
+            if (r < 0 || r >= rows) continue;
+            __global const int* inputRow = input + (size_t)(r - inputStart) * cols;
+            for (int m = 0; m < kDim; ++m) {
+                int c = Col - kOffset + m * dDim;
+                if (c >= 0 && c < cols) {
+                    Cvalue += (ACC_TYPE)kernelVals[k * kDim + m] * inputRow[c];
+                }
+            }
+        }
+
+        //Assign values to output
+        convolved[(size_t)Row * cols + Col] = Cvalue;
+    }
+    """
+
+    # Pre-calculate values used across all threads
+    matrix_row_size = matrix.shape[0]
+    matrix_col_size = matrix.shape[1]
+    kernelDim = int(np.sqrt(len(filterVec)))
+    kernelExpandedDim = (dDim-1)*(kernelDim-1)+kernelDim # Expanded Size
+    dconv_offset = int(kernelExpandedDim/2) # value used to center input matrix on kernel
+    haloAbove = dconv_offset
+    haloBelow = kernelExpandedDim - 1 - dconv_offset
+    # One streaming pass over the input for the bound, see dconvBound()
+    accOptions, accDtype = _accumulatorOptions(matrix, filterVec, accType)
+
+    # Output rows per band so band + halo fits bandBytes and the device alloc limit
+    rowBytes = matrix_col_size * max(np.dtype(np.int32).itemsize, np.dtype(accDtype).itemsize)
+    maxBytes = min(bandBytes, dev[0].max_mem_alloc_size)
+    if (1 + haloAbove + haloBelow) * rowBytes > maxBytes:
+        raise Exception('bandBytes must hold one row plus the {}-row halo ({} bytes), but get {}'.format(
+            haloAbove + haloBelow, (1 + haloAbove + haloBelow) * rowBytes, maxBytes))
+    bandRows = int(min(matrix_row_size, maxBytes // rowBytes - haloAbove - haloBelow))
+    bands = [(b, min(b + bandRows, matrix_row_size)) for b in range(0, matrix_row_size, bandRows)]
+
+    if out is None:
+        out = np.empty((matrix_row_size, matrix_col_size), dtype=accDtype)
+    elif isinstance(out, str):
+        out = np.memmap(out, dtype=accDtype, mode='w+', shape=(matrix_row_size, matrix_col_size))
+    elif not np.can_cast(accDtype, out.dtype):
+        raise Exception('out must hold {} results, but get {}'.format(np.dtype(accDtype), out.dtype))
+
+    def readBand(band):
+        # Input rows the band touches, clipped to the image
+        inputStart = max(0, band[0] - haloAbove)
+        inputStop = min(matrix_row_size, band[1] + haloBelow)
+        return [inputStart, np.ascontiguousarray(matrix[inputStart:inputStop], dtype=np.int32)]
+
+    def writeBand(band, result):
+        out[band[0]:band[1]] = result
+
+    #Device buffers sized for the largest band, reused for every band
+    filterVec_gpu = cl.array.to_device(queue, np.asarray(filterVec).astype(np.int32), allocator=pool)
+    input_gpu = cl.array.empty(queue, ((bandRows + haloAbove + haloBelow) * matrix_col_size,), np.int32, allocator=pool)
+    convolved = cl.array.empty(queue, (bandRows * matrix_col_size,), accDtype, allocator=pool)
+
+    knl = build_kernel(ctx, kernel, accOptions)
+
+    start = time.time()
+    reader = concurrent.futures.ThreadPoolExecutor(1)
+    writer = concurrent.futures.ThreadPoolExecutor(1)
+    try:
+        pending = reader.submit(readBand, bands[0])
+        writes = []
+        for n, band in enumerate(bands):
+            inputStart, band_in = pending.result()
+            if n + 1 < len(bands):
+                pending = reader.submit(readBand, bands[n + 1])
+
+            #Move band to device, launch, read back
+            cl.enqueue_copy(queue, input_gpu.data, band_in)
+            rows = band[1] - band[0]
+            knl(queue, (matrix_col_size, rows), None, input_gpu.data, filterVec_gpu.data, convolved.data,
+                np.int32(matrix_row_size), np.int32(matrix_col_size), np.int32(dDim), np.int32(kernelDim),
+                np.int32(dconv_offset), np.int32(band[0]), np.int32(rows), np.int32(inputStart))
+            result = np.empty((rows, matrix_col_size), dtype=accDtype)
+            cl.enqueue_copy(queue, result, convolved.data)
+
+            #Write on the worker while the next band computes
+            writes.append(writer.submit(writeBand, band, result))
+            if len(writes) > 2:
+                writes.pop(0).result()
+        for w in writes:
+            w.result()
+    finally:
+        reader.shutdown()
+        writer.shutdown()
+    if isinstance(out, np.memmap):
+        out.flush()
+    runtime = time.time()-start
+
+    return [out, runtime]
+
+def dconv_engine(shape, kernelDim, dDim, bound=0, separable=False):
+    """
+    Pick direct, separable or FFT dilated convolution from the problem size
+        -> direct cost: KDIM^2 * rows * cols (2*KDIM * rows * cols if separable)
+        -> FFT cost: FFT_COST_RATIO * P * log2(P), P = padded FFT size
+        -> FFT only while its rounding is exact (bound < FFT_EXACT_LIMIT)
+    Input:
+        variable shape: (rows, cols) of the input
+        variable kernelDim: KDIM
+        variable dDim: dilation coefficient
+        variable bound: largest possible |output|, sum(|filter|) * max(|input|)
+        variable separable: filter is integer rank-1 (separableFilter)
+    Return/Output: 'direct', 'separable' or 'fft'
+    """
+    correlationDim = (dDim-1)*(kernelDim-1)+kernelDim
+    P = _fftLen(shape[0] + correlationDim - 1) * _fftLen(shape[1] + correlationDim - 1)
+    direct = (2*kernelDim if separable else kernelDim*kernelDim) * shape[0] * shape[1]
+    fft = FFT_COST_RATIO * P * np.log2(P)
+    if fft < direct and bound < FFT_EXACT_LIMIT:
+        return 'fft'
+    return 'separable' if separable else 'direct'
+
+def dconv_auto(matrix, filterVec, dDim, gpu=True, accType='auto'):
+    """
+    Calculate dilated conv of a MxN matrix with the cheaper engine
+    Input:
+        variable matrix: JxK numpy 2-d array of integer values
+        variable filterVec: Filter values
+        variable dDim: dilation coefficient
+        variable gpu: openCL engines (dconv_tiled/dconv_separable/dconv_fft) or numpy ones
+        variable accType: accumulator/output type of the direct openCL engines, see accumulatorType()
+    Return/Output: [convolved, runtime], engine name in dconvStats['engine']
+    """
+    # One pass over the input for both the engine choice and the accumulator
+    absMax = _absMax(matrix)
+    bound = dconvBound(matrix, filterVec, absMax)
+    accType = accumulatorType(matrix, filterVec, accType, absMax)
+    if gpu and not np.can_cast(matrix.dtype, np.int32):
+        # The openCL engines take int32 input, checked here with the same absMax
+        if absMax > np.iinfo(np.int32).max:
+            raise Exception('input values must fit int32')
+        matrix = np.asarray(matrix, dtype=np.int32)
+    separable = separableFilter(filterVec) is not None
+    engine = dconv_engine(matrix.shape, int(np.sqrt(len(filterVec))), dDim, bound, separable)
+    dconvStats['engine'] = engine
+    if engine == 'fft':
+        return dconv_fft(matrix, filterVec, dDim) if gpu else python_dconv_fft(matrix, filterVec, dDim)
+    if engine == 'separable':
+        return dconv_separable(matrix, filterVec, dDim, accType) if gpu else python_dconv_separable(matrix, filterVec, dDim)
+    return dconv_tiled(matrix, filterVec, dDim, accType=accType) if gpu else python_dconv_vectorized(matrix, filterVec, dDim)
+
 def python_dconv_verify(matrix, filterVec, dDim):
     """
     Verify dilated conv of a MxN matrix using correlation
@@ -250,6 +1092,81 @@ def python_dconv(matrix, filterVec, dDim):
     end = time.time()-start
     return [output, end]
 
+def python_dconv_vectorized(matrix, filterVec, dDim):
+    """
+    Calculate dilated conv of a MxN matrix with shifted array slices
+        -> input zero-padded by the dilated halo once
+        -> one multiply-add of a shifted MxN view per filter tap (KDIM*KDIM
+           whole-array ops instead of M*N*KDIM*KDIM python iterations)
+        -> int64 accumulator, values equal python_dconv and dconv exactly
+    Input:
+        variable matrix: JxK numpy 2-d array of integer values
+        variable filterVec: Filter values
+        variable dDim: dilation coefficient
+    Return/Output: [convolved, runtime]
+    """
+
+    # Calculate expanded kernel size and centering offset, as python_dconv
+    filterDim = int(np.sqrt(len(filterVec)))
+    correlationDim = (dDim-1)*(filterDim-1)+filterDim
+    dconv_offset = int(correlationDim/2) # value used to center input matrix on kernel
+    rows, cols = matrix.shape
+
+    start = time.time()
+
+    # Zero halo: offset before, the rest of the expanded kernel after
+    padded = np.zeros([rows + correlationDim - 1, cols + correlationDim - 1], dtype=np.int64)
+    padded[dconv_offset:dconv_offset+rows, dconv_offset:dconv_offset+cols] = matrix
+
+    # Accumulate each tap's shifted view
+    output = np.zeros([rows, cols], dtype=np.int64)
+    taps = np.asarray(filterVec).astype(np.int64).reshape(filterDim, filterDim)
+    for k in range(filterDim):
+        for m in range(filterDim):
+            if taps[k, m]:
+                output += taps[k, m] * padded[k*dDim:k*dDim+rows, m*dDim:m*dDim+cols]
+
+    end = time.time()-start
+    return [output, end]
+
+def python_dconv_nchw(images, filters, dDim, sumChannels=False):
+    """
+    Calculate dilated convs of a (N, C, H, W) stack with shifted array slices
+        -> python_dconv_vectorized over all images and channels at once,
+           per-channel taps broadcast along C
+        -> int64 accumulator, equal to dconv_nchw
+    Input:
+        variable images: (N, C, H, W) numpy array of integer values
+        variable filters: (C, KDIM, KDIM) per-channel filters or one (KDIM, KDIM) filter
+        variable dDim: dilation coefficient
+        variable sumChannels: sum over channels instead of one output per channel
+    Return/Output: [convolved, runtime]
+    """
+    N, C, rows, cols = images.shape
+    filters = _channelFilters(filters, C).astype(np.int64)
+    filterDim = filters.shape[1]
+    correlationDim = (dDim-1)*(filterDim-1)+filterDim
+    dconv_offset = int(correlationDim/2) # value used to center input matrix on kernel
+
+    start = time.time()
+
+    # Zero halo around every plane
+    padded = np.zeros([N, C, rows + correlationDim - 1, cols + correlationDim - 1], dtype=np.int64)
+    padded[:, :, dconv_offset:dconv_offset+rows, dconv_offset:dconv_offset+cols] = images
+
+    # Accumulate each tap's shifted view, one weight per channel
+    output = np.zeros([N, C, rows, cols], dtype=np.int64)
+    for k in range(filterDim):
+        for m in range(filterDim):
+            taps = filters[:, k, m]
+            if taps.any():
+                output += taps[None, :, None, None] * padded[:, :, k*dDim:k*dDim+rows, m*dDim:m*dDim+cols]
+    if sumChannels:
+        output = output.sum(axis=1)
+
+    end = time.time()-start
+    return [output, end]
+
 if __name__=="__main__":
     # Starting dims
     ydim=100
@@ -333,7 +1250,11 @@ if __name__=="__main__":
                 print("CPU Output:\n%s\n" % cpuConvolved)
 
             print('[%d, %d, dilation=%d] -> OpenCL_dconv==cpuDConv: %s' % (ydim, xdim, dDim, np.allclose(gpuConvolved, cpuConvolved)))
-            print('OpenCL_runtime: %.2E, CPU_runtime: %.2E\n' %(gpuRuntime, cpuRuntime))
+            vecConvolved, vecRuntime = python_dconv_vectorized(tmp, filterVec, dDim)
+            tiledConvolved, tiledRuntime = dconv_tiled(tmp, filterVec, dDim)
+            print('OpenCL_tiled_dconv==OpenCL_dconv: %s, OpenCL_tiled_runtime: %.2E' % (np.array_equal(tiledConvolved, gpuConvolved), tiledRuntime))
+            print('cpuVectorizedDConv==OpenCL_dconv: %s, cpuVectorizedDConv==cpuDConv: %s' % (np.array_equal(vecConvolved, gpuConvolved), np.array_equal(vecConvolved, cpuConvolved)))
+            print('OpenCL_runtime: %.2E, CPU_runtime: %.2E, CPU_vectorized_runtime: %.2E\n' %(gpuRuntime, cpuRuntime, vecRuntime))
             print("-----------------------------")
 
         # Plot
@@ -383,7 +1304,11 @@ if __name__=="__main__":
                 print("CPU Output:\n%s\n" % cpuConvolved)
 
             print('[%d, %d] -> OpenCL_dconv==cpuDConv: %s' % (y, x, np.allclose(gpuConvolved, cpuConvolved)))
-            print('OpenCL_runtime: %.2E, CPU_runtime: %.2E\n' %(gpuRuntime, cpuRuntime))
+            vecConvolved, vecRuntime = python_dconv_vectorized(tmp, filterVec, dDim)
+            tiledConvolved, tiledRuntime = dconv_tiled(tmp, filterVec, dDim)
+            print('OpenCL_tiled_dconv==OpenCL_dconv: %s, OpenCL_tiled_runtime: %.2E' % (np.array_equal(tiledConvolved, gpuConvolved), tiledRuntime))
+            print('cpuVectorizedDConv==OpenCL_dconv: %s, cpuVectorizedDConv==cpuDConv: %s' % (np.array_equal(vecConvolved, gpuConvolved), np.array_equal(vecConvolved, cpuConvolved)))
+            print('OpenCL_runtime: %.2E, CPU_runtime: %.2E, CPU_vectorized_runtime: %.2E\n' %(gpuRuntime, cpuRuntime, vecRuntime))
             print("-----------------------------")
 
         # Plot
@@ -431,7 +1356,13 @@ if __name__=="__main__":
                 print("CPU Output:\n%s\n" % cpuConvolved)
 
             print('[%d, %d, kernelSize:[%d,%d]] -> OpenCL_dconv==cpuDConv: %s' % (ydim, xdim, i, i, np.allclose(gpuConvolved, cpuConvolved)))
-            print('OpenCL_runtime: %.2E, CPU_runtime: %.2E\n' %(gpuRuntime, cpuRuntime))
+            autoConvolved, autoRuntime = dconv_auto(tmp, filterVec, dDim)
+            print('dconv_auto (%s)==OpenCL_dconv: %s, auto_runtime: %.2E' % (dconvStats['engine'], np.array_equal(autoConvolved, gpuConvolved), autoRuntime))
+            vecConvolved, vecRuntime = python_dconv_vectorized(tmp, filterVec, dDim)
+            tiledConvolved, tiledRuntime = dconv_tiled(tmp, filterVec, dDim)
+            print('OpenCL_tiled_dconv==OpenCL_dconv: %s, OpenCL_tiled_runtime: %.2E' % (np.array_equal(tiledConvolved, gpuConvolved), tiledRuntime))
+            print('cpuVectorizedDConv==OpenCL_dconv: %s, cpuVectorizedDConv==cpuDConv: %s' % (np.array_equal(vecConvolved, gpuConvolved), np.array_equal(vecConvolved, cpuConvolved)))
+            print('OpenCL_runtime: %.2E, CPU_runtime: %.2E, CPU_vectorized_runtime: %.2E\n' %(gpuRuntime, cpuRuntime, vecRuntime))
             print("-----------------------------")
 
         # Plot
@@ -449,3 +1380,58 @@ if __name__=="__main__":
         plt.ticklabel_format(axis='y',style='sci')
         # ax.yaxis.set_major_formatter(mpl.ticker.FormatStrFormatter('%.2e'))
         plt.savefig('pythonCPU_maskSize_gpuOpenCL_plot.png',bbox_inches='tight')
+
+    # Batched filter bank: one upload, one launch
+    if 1==1:
+        filterBank = np.random.randint(100,size=(16,3,3))
+        dDims = np.random.randint(1,high=6,size=16)
+        tmp = np.random.randint(0,high=100,size=(ydim,xdim))
+
+        batchConvolved, batchRuntime = dconv_batched(tmp, filterBank, dDims)
+        loopRuntime = 0
+        batchEqual = True
+        for f in range(filterBank.shape[0]):
+            gpuConvolved, gpuRuntime = dconv(tmp, filterBank[f].reshape(-1), dDims[f])
+            loopRuntime += gpuRuntime
+            batchEqual = batchEqual and np.array_equal(batchConvolved[f], gpuConvolved)
+        print('[%d, %d, %d filters] -> OpenCL_batched_dconv==OpenCL_dconv: %s' % (ydim, xdim, filterBank.shape[0], batchEqual))
+        print('OpenCL_batched_runtime: %.2E, OpenCL_per_filter_runtime: %.2E\n' % (batchRuntime, loopRuntime))
+
+    # Image stacks: (N, C, H, W) in one launch
+    if 1==1:
+        images = np.random.randint(0,high=100,size=(32,3,ydim,xdim))
+        filters = np.random.randint(100,size=(3,3,3))
+        dDim = 2
+        for sumChannels in (False, True):
+            gpuConvolved, gpuRuntime = dconv_nchw(images, filters, dDim, sumChannels)
+            gpuRate = dconvStats['images_per_sec']
+            cpuConvolved, cpuRuntime = python_dconv_nchw(images, filters, dDim, sumChannels)
+            print('[%s, sumChannels=%s] -> OpenCL_nchw_dconv==cpuNchwDConv: %s' % (images.shape, sumChannels, np.array_equal(gpuConvolved, cpuConvolved)))
+            print('OpenCL: %.1f images/s, CPU_vectorized: %.1f images/s\n' % (gpuRate, images.shape[0] / cpuRuntime))
+
+    # Out-of-core: memmapped input streamed in row bands to a memmapped output
+    if 1==1:
+        filterVec = np.random.randint(100,size=25)
+        dDim = 4
+        tmpDir = tempfile.mkdtemp()
+        big = np.memmap(os.path.join(tmpDir, 'dconv_in.dat'), dtype=np.int32, mode='w+', shape=(4096,2048))
+        big[:] = np.random.randint(0,high=100,size=big.shape)
+        big.flush()
+
+        streamConvolved, streamRuntime = dconv_stream(big, filterVec, dDim, out=os.path.join(tmpDir, 'dconv_out.dat'), bandBytes=2**22)
+        gpuConvolved, gpuRuntime = dconv(np.asarray(big), filterVec, dDim)
+        print('[%d, %d, dilation=%d] -> OpenCL_stream_dconv==OpenCL_dconv: %s' % (big.shape[0], big.shape[1], dDim, np.array_equal(streamConvolved, gpuConvolved)))
+        print('OpenCL_stream_runtime: %.2E\n' % streamRuntime)
+        del big, streamConvolved
+        shutil.rmtree(tmpDir)
+
+    # Accumulator types: large values overflow int32, auto widens to int64
+    if 1==1:
+        tmp = np.random.randint(0,high=2**20,size=(ydim,xdim))
+        filterVec = np.random.randint(2**10,size=144)
+        dDim = 3
+        cpuConvolved, cpuRuntime = python_dconv_vectorized(tmp, filterVec, dDim)
+        print('[%d, %d] bound %d -> auto accumulator: %s' % (ydim, xdim, dconvBound(tmp, filterVec), accumulatorType(tmp, filterVec)))
+        for accType in ('int32', 'int64', 'float32', 'auto'):
+            gpuConvolved, gpuRuntime = dconv(tmp, filterVec, dDim, accType=accType)
+            print('accType=%s -> OpenCL_dconv==cpuVectorizedDConv: %s, OpenCL_runtime: %.2E' % (accType, np.array_equal(gpuConvolved, cpuConvolved), gpuRuntime))
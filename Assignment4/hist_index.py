@@ -0,0 +1,215 @@
+"""
+Integral (cumulative) histogram index and multi-resolution pyramid
+    -> 2-d prefix sum over the (side, side, bins) tile counts
+    -> histogram of any tile-aligned rectangle in O(bins): four lookups
+    -> base tile size is a choice: a finer base (exponent 8 -> 256x256) answers
+       queries aligned to the finer grid and every coarser one
+    -> persisted next to the data file, tagged with the file's size/mtime so a
+       rewritten data file is never answered from a stale index
+    -> pyramid: tile counts at every power-of-two tile size between a finest
+       and a coarsest exponent, coarser levels are 2x2 sums of the finer one
+Counts come from any backend (histogramLayout, histogramParallel, histStrip, ...)
+in the flat i*side+j tile order they all produce.
+"""
+import os
+
+import numpy as np
+
+from hist_layout import BinLayout, histogramLayout
+
+INDEX_SUFFIX = '.hidx.npz'
+
+
+def indexPath(dataPath, tag=''):
+    """
+    Return/Output: file the index of dataPath is persisted to
+    Input:
+        variable tag: tells several indexes of one file apart (region, tile size)
+    """
+    return dataPath + tag + INDEX_SUFFIX
+
+
+def _sourceStamp(dataPath):
+    st = os.stat(dataPath)
+    return np.array([st.st_size, st.st_mtime_ns], dtype=np.int64)
+
+
+class HistogramIndex(object):
+    """
+    Integral histogram over a grid of square tiles
+    Input:
+        variable prefix: (rows+1, cols+1, bins) int64, prefix[i, j] = counts of tiles [:i, :j]
+        variable tileSize: tile side in pixels
+        variable layout: BinLayout the counts were binned with
+    """
+
+    def __init__(self, prefix, tileSize, layout=None):
+        self.prefix = prefix
+        self.tileSize = int(tileSize)
+        self.layout = layout or BinLayout.default()
+        self.rows = prefix.shape[0] - 1
+        self.cols = prefix.shape[1] - 1
+        self.bins = prefix.shape[2]
+
+    @classmethod
+    def fromCounts(cls, counts, tileSize, layout=None):
+        """
+        Build the index from flat tile counts
+        Input:
+            variable counts: flat array of side*side*bins counts, tile order i*side+j
+            variable tileSize: tile side in pixels (2^exponent)
+            variable layout: BinLayout of the counts (None -> BinLayout.default())
+        Return/Output: HistogramIndex
+        """
+        layout = layout or BinLayout.default()
+        counts = np.asarray(counts)
+        side = int(round(np.sqrt(counts.size // layout.bins)))
+        if side * side * layout.bins != counts.size:
+            raise ValueError('counts must hold side*side*{} values, but get {}'.format(layout.bins, counts.size))
+        return cls.fromTiles(counts.reshape(side, side, layout.bins), tileSize, layout)
+
+    @classmethod
+    def fromTiles(cls, tiles, tileSize, layout=None):
+        """
+        Build the index from a (rows, cols, bins) array of tile counts
+        Return/Output: HistogramIndex
+        """
+        rows, cols, bins = tiles.shape
+        prefix = np.zeros((rows + 1, cols + 1, bins), dtype=np.int64)
+        np.cumsum(np.cumsum(tiles.astype(np.int64), axis=0), axis=1, out=prefix[1:, 1:])
+        return cls(prefix, tileSize, layout)
+
+    @classmethod
+    def build(cls, data, exponent=10, layout=None, chunkElements=2**16):
+        """
+        Bin data on the CPU and build the index
+        Input:
+            variable data: 2-d integer numpy array (or memmap)
+            variable exponent: base tile size is 2^exponent by 2^exponent
+            variable layout: BinLayout (None -> BinLayout.default())
+            variable chunkElements: elements binned per vectorized pass
+        Return/Output: HistogramIndex
+        """
+        counts = histogramLayout(data, layout, exponent, chunkElements)
+        return cls.fromCounts(counts, 2**exponent, layout)
+
+    def queryTiles(self, tileRowStart, tileRowStop, tileColStart, tileColStop):
+        """
+        Histogram of tiles [tileRowStart, tileRowStop) x [tileColStart, tileColStop)
+        Return/Output: int64 array of bins counts
+        """
+        if not (0 <= tileRowStart <= tileRowStop <= self.rows and 0 <= tileColStart <= tileColStop <= self.cols):
+            raise ValueError('tile rectangle ({}:{}, {}:{}) outside the {}x{} grid'.format(
+                tileRowStart, tileRowStop, tileColStart, tileColStop, self.rows, self.cols))
+        p = self.prefix
+        return p[tileRowStop, tileColStop] - p[tileRowStart, tileColStop] \
+            - p[tileRowStop, tileColStart] + p[tileRowStart, tileColStart]
+
+    def query(self, rowStart, rowStop, colStart, colStop):
+        """
+        Histogram of pixels [rowStart, rowStop) x [colStart, colStop)
+        Input:
+            variable rowStart, rowStop, colStart, colStop: pixel bounds, multiples of tileSize
+        Return/Output: int64 array of bins counts
+        """
+        bounds = (rowStart, rowStop, colStart, colStop)
+        if any(b % self.tileSize for b in bounds):
+            raise ValueError('rectangle {} is not aligned to {}-pixel tiles, build the index with a finer exponent'
+                             .format(bounds, self.tileSize))
+        return self.queryTiles(*[b // self.tileSize for b in bounds])
+
+    def save(self, path, dataPath=None):
+        """
+        Write the index (atomic rename)
+        Input:
+            variable path: output file, see indexPath()
+            variable dataPath: data file the index describes, stamped for staleness checks
+        """
+        stamp = _sourceStamp(dataPath) if dataPath else np.zeros(2, dtype=np.int64)
+        tmp = path + '.tmp.npz'
+        np.savez(tmp, prefix=self.prefix, tileSize=self.tileSize, edges=self.layout.edges,
+                 policy=self.layout.policy, source=stamp)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path, dataPath=None):
+        """
+        Read an index written by save()
+        Input:
+            variable path: index file
+            variable dataPath: if given, return None when the data changed since save()
+        Return/Output: HistogramIndex or None (missing or stale)
+        """
+        if not os.path.exists(path):
+            return None
+        with np.load(path) as f:
+            if dataPath and not np.array_equal(f['source'], _sourceStamp(dataPath)):
+                return None
+            layout = BinLayout(edges=f['edges'], policy=str(f['policy']))
+            return cls(f['prefix'], int(f['tileSize']), layout)
+
+
+class HistogramPyramid(object):
+    """
+    Tile histograms at several tile sizes
+    Input:
+        variable levels: dict exponent -> (rows, cols, bins) int64 tile counts
+        variable layout: BinLayout the counts were binned with
+    """
+
+    def __init__(self, levels, layout=None):
+        self.levels = levels
+        self.layout = layout or BinLayout.default()
+
+    @classmethod
+    def fromFinest(cls, tiles, finest, coarsest, layout=None):
+        """
+        Derive the coarser levels from the finest one by 2x2 sums
+        Input:
+            variable tiles: (rows, cols, bins) counts at 2^finest tiles
+            variable finest, coarsest: exponents of the smallest and largest tile size
+        Return/Output: HistogramPyramid
+        """
+        if coarsest < finest:
+            raise ValueError('coarsest must be >= finest, but get {} < {}'.format(coarsest, finest))
+        levels = {finest: np.asarray(tiles, dtype=np.int64)}
+        for e in range(finest + 1, coarsest + 1):
+            fine = levels[e - 1]
+            rows, cols = fine.shape[0] // 2, fine.shape[1] // 2
+            # A partial 2x2 block is dropped, as histogram() drops partial tiles
+            levels[e] = fine[:2*rows, :2*cols].reshape(rows, 2, cols, 2, -1).sum(axis=(1, 3))
+        return cls(levels, layout)
+
+    @classmethod
+    def build(cls, data, finest=8, coarsest=10, layout=None, chunkElements=2**16):
+        """
+        CPU pyramid: one binning pass at the finest tile size
+        Input:
+            variable data: 2-d integer numpy array (or memmap)
+            variable finest, coarsest: exponents of the smallest and largest tile size
+            variable layout: BinLayout (None -> BinLayout.default())
+            variable chunkElements: elements binned per vectorized pass
+        Return/Output: HistogramPyramid
+        """
+        layout = layout or BinLayout.default()
+        counts = histogramLayout(data, layout, finest, chunkElements)
+        side = int(data.shape[0] / 2**finest)
+        return cls.fromFinest(counts.reshape(side, side, layout.bins), finest, coarsest, layout)
+
+    @property
+    def exponents(self):
+        return sorted(self.levels)
+
+    def level(self, exponent):
+        """
+        Return/Output: flat counts of one level, tile order i*side+j as histogram()
+        """
+        return self.levels[exponent].reshape(-1)
+
+    def index(self, exponent=None):
+        """
+        Integral index over one level (None -> finest)
+        Return/Output: HistogramIndex
+        """
+        exponent = self.exponents[0] if exponent is None else exponent
+        return HistogramIndex.fromTiles(self.levels[exponent], 2**exponent, self.layout)
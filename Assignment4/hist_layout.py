@@ -0,0 +1,167 @@
+"""
+Histogram bin layouts shared by the CPU and openCL backends
+    -> uniform (lo, hi, bins) or explicit integer edges
+    -> np.histogram semantics: bins are [e_i, e_i+1), the last bin is closed
+    -> out-of-range policy: 'drop' (np.histogram) or 'clamp' into the end bins
+    -> no division in the hot loop: uniform integer widths use a precomputed
+       reciprocal (multiply + shift sized from the range, a plain shift for
+       power-of-two widths), anything else a lookup table over [lo, hi] kept
+       in global memory, so any range fits the device
+Both backends evaluate the same integer arithmetic so their counts agree exactly.
+"""
+import numpy as np
+
+
+class BinLayout(object):
+    """
+    Integer histogram bin layout
+    Input:
+        variable lo, hi: value range, hi is included in the last bin
+        variable bins: number of uniform bins over [lo, hi]
+        variable edges: explicit increasing integer edges (overrides lo/hi/bins)
+        variable policy: 'drop' or 'clamp' for values outside [lo, hi]
+    """
+
+    def __init__(self, lo=0, hi=180, bins=18, edges=None, policy='drop'):
+        if policy not in ('drop', 'clamp'):
+            raise ValueError("policy must be 'drop' or 'clamp', but get {}".format(policy))
+        if edges is None:
+            edges = np.linspace(lo, hi, bins + 1)
+        edges = np.asarray(edges, dtype=np.float64)
+        if edges.ndim != 1 or len(edges) < 2 or np.any(np.diff(edges) <= 0):
+            raise ValueError('edges must be a 1-d increasing sequence')
+
+        self.edges = edges
+        self.bins = len(edges) - 1
+        self.policy = policy
+        self.lo = int(np.ceil(edges[0]))
+        self.hi = int(np.floor(edges[-1]))
+
+        # Uniform integer width -> reciprocal multiply/shift, else lookup table
+        self.mul = None
+        self.shift = None
+        self.lut = None
+        width = (edges[-1] - edges[0]) / self.bins
+        uniform = np.allclose(np.diff(edges), width, rtol=0, atol=0) and float(width).is_integer() \
+            and float(edges[0]).is_integer()
+        if uniform:
+            width = int(width)
+            if width & (width - 1) == 0:
+                # Plain shift, exact for any range
+                self.mul, self.shift = 1, width.bit_length() - 1
+            else:
+                # Round-up reciprocal, exact for offsets below 2^rangeBits
+                # while the ulong product offset*mul cannot overflow
+                rangeBits = (self.hi - self.lo).bit_length()
+                shift = rangeBits + (width - 1).bit_length()
+                mul = ((1 << shift) + width - 1) // width
+                if mul * (self.hi - self.lo) < 2**64:
+                    self.mul, self.shift = mul, shift
+                else:
+                    uniform = False
+        if not uniform:
+            values = np.arange(self.lo, self.hi + 1)
+            lut = np.searchsorted(edges, values, side='right') - 1
+            lut[values == edges[-1]] = self.bins - 1
+            self.lut = lut.astype(np.int32)
+
+    @classmethod
+    def default(cls):
+        """
+        Return/Output: the assignment's layout, np.arange(0, 181, 10) with drop
+        """
+        return cls(0, 180, 18)
+
+    def key(self):
+        """
+        Hashable description used to tell compiled layouts apart
+        """
+        return (self.bins, self.lo, self.hi, self.policy, self.mul, self.shift,
+                None if self.lut is None else self.lut.tobytes())
+
+    def binIndex(self, values):
+        """
+        Bin index of every value, -1 where the drop policy discards it
+        Input:
+            variable values: integer numpy array
+        Return/Output: intp array of the same shape
+        """
+        v = np.asarray(values).astype(np.int64)
+        if self.policy == 'clamp':
+            v = np.clip(v, self.lo, self.hi)
+            valid = None
+        else:
+            valid = (v >= self.lo) & (v <= self.hi)
+            v = np.where(valid, v, self.lo)
+        offset = v - self.lo
+        if self.lut is not None:
+            idx = self.lut[offset].astype(np.intp)
+        else:
+            idx = ((offset.astype(np.uint64) * np.uint64(self.mul)) >> np.uint64(self.shift)).astype(np.intp)
+            np.minimum(idx, self.bins - 1, out=idx)
+        if valid is not None:
+            idx[~valid] = -1
+        return idx
+
+    def clDefines(self):
+        """
+        Compile-time constants for the openCL bin function (see CL_BIN_FUNCTION)
+        Return/Output: dict of -D values
+        """
+        defines = {'BINS': self.bins, 'BIN_LO': self.lo, 'BIN_HI': self.hi,
+                   'BIN_CLAMP': int(self.policy == 'clamp'), 'BIN_USE_LUT': int(self.lut is not None)}
+        if self.lut is None:
+            defines.update(BIN_MUL=self.mul, BIN_SHIFT=self.shift)
+        return defines
+
+    def clLut(self):
+        """
+        Return/Output: int32 lookup table for the device (one dummy entry when unused)
+        """
+        return self.lut if self.lut is not None else np.zeros(1, dtype=np.int32)
+
+
+# openCL bin function, configured by BinLayout.clDefines()
+CL_BIN_FUNCTION = """
+    inline int binOf(int v, __global const int* binLut) {
+    #if BIN_CLAMP
+        v = clamp(v, BIN_LO, BIN_HI);
+    #else
+        if (v < BIN_LO || v > BIN_HI) return -1;
+    #endif
+    #if BIN_USE_LUT
+        return binLut[v - BIN_LO];
+    #else
+        return min((int)(((ulong)(v - BIN_LO) * BIN_MUL) >> BIN_SHIFT), BINS - 1);
+    #endif
+    }
+"""
+
+
+def histogramLayout(data, layout=None, exponent=10, chunkElements=2**16):
+    """
+    CPU tile histograms for any bin layout
+    Input:
+        variable data: 2-d integer numpy array (or memmap)
+        variable layout: BinLayout (None -> BinLayout.default())
+        variable exponent: sub-region size is 2^exponent by 2^exponent
+        variable chunkElements: elements binned per vectorized pass
+    Return/Output: flat int64 array of tiles * layout.bins counts
+    """
+    layout = layout or BinLayout.default()
+    base = int(np.power(2, exponent))
+    side = int(data.shape[0] / base)
+    nbins = layout.bins
+    counts = np.zeros((side, side * nbins), dtype=np.int64)
+    offsets = (np.arange(side, dtype=np.intp) * nbins).reshape(1, side, 1)
+    rowsPerPass = int(max(1, min(base, chunkElements // max(1, side * base))))
+
+    for i in range(side):
+        for r in range(i*base, (i+1)*base, rowsPerPass):
+            rows = min(rowsPerPass, (i+1)*base - r)
+            values = np.asarray(data[r:r+rows, :side*base]).reshape(rows, side, base)
+            idx = layout.binIndex(values)
+            keep = idx >= 0
+            idx += offsets
+            counts[i] += np.bincount(idx[keep], minlength=side*nbins)
+    return counts.reshape(-1)
@@ -0,0 +1,119 @@
+"""
+Compact on-disk format for per-tile histograms
+    -> 64-byte header: magic, version, count width, tile grid shape, bins,
+       tile size and a checksum of the source data
+    -> dense (rows, cols, bins) counts, little-endian, in the narrowest
+       unsigned width that holds the largest count (uint8/16/32/64)
+    -> readers memory-map the counts, a single tile is one bins-sized read
+
+Layout:
+    offset 0   4s  magic b'HIST'
+    offset 4   H   version
+    offset 6   H   bytes per count
+    offset 8   I   tile rows
+    offset 12  I   tile cols
+    offset 16  I   bins
+    offset 20  I   tile size (pixels per side)
+    offset 24  Q   source checksum
+    offset 32      zero padding
+    offset 64      counts, tile order i*cols+j as histogram()
+"""
+import os
+import struct
+
+import numpy as np
+
+MAGIC = b'HIST'
+VERSION = 1
+HEADER = struct.Struct('<4sHHIIIIQ')
+DATA_OFFSET = 64
+
+_WIDTHS = [np.uint8, np.uint16, np.uint32, np.uint64]
+
+
+def countType(maxCount):
+    """
+    Return/Output: narrowest unsigned dtype holding maxCount
+    """
+    for dtype in _WIDTHS:
+        if maxCount <= np.iinfo(dtype).max:
+            return np.dtype(dtype).newbyteorder('<')
+    raise ValueError('count {} does not fit in 64 bits'.format(maxCount))
+
+
+def writeHistResult(path, counts, tileSize, bins=18, rows=None, checksum=0):
+    """
+    Write tile histograms in the compact format (atomic rename)
+    Input:
+        variable path: output file
+        variable counts: flat tiles*bins counts (any backend) or (rows, cols, bins) array,
+                         empty counts give a header-only file
+        variable tileSize: tile side in pixels (2^exponent)
+        variable bins: bins per tile
+        variable rows: tile rows for flat non-square grids (None -> square)
+        variable checksum: 64-bit checksum of the source data
+    Return/Output: dtype the counts were stored in
+    """
+    counts = np.asarray(counts)
+    if counts.ndim != 3:
+        tiles = counts.size // bins
+        rows = int(round(np.sqrt(tiles))) if rows is None else rows
+        # No counts -> empty grid, stored as a header-only file
+        cols = tiles // rows if rows else 0
+        if tiles * bins != counts.size or rows * cols != tiles:
+            raise ValueError('counts of size {} do not form a grid with {} bins'.format(counts.size, bins))
+        counts = counts.reshape(rows, cols, bins)
+    rows, cols, bins = counts.shape
+    if counts.size and counts.min() < 0:
+        raise ValueError('counts must be non-negative')
+    dtype = countType(int(counts.max()) if counts.size else 0)
+
+    header = HEADER.pack(MAGIC, VERSION, dtype.itemsize, rows, cols, bins, int(tileSize), int(checksum) & (2**64 - 1))
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(header.ljust(DATA_OFFSET, b'\0'))
+        f.write(np.ascontiguousarray(counts, dtype=dtype).tobytes())
+    os.replace(tmp, path)
+    return dtype
+
+
+class HistResultFile(object):
+    """
+    Memory-mapped reader of a file written by writeHistResult()
+    Input:
+        variable path: result file
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            raw = f.read(HEADER.size)
+        if len(raw) < HEADER.size:
+            raise ValueError('{} is too short for a histogram result'.format(path))
+        magic, version, itemsize, rows, cols, bins, tileSize, checksum = HEADER.unpack(raw)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('{} is not a version {} histogram result'.format(path, VERSION))
+
+        self.path = path
+        self.rows = rows
+        self.cols = cols
+        self.bins = bins
+        self.tileSize = tileSize
+        self.checksum = checksum
+        self.dtype = countType(np.iinfo(np.dtype('u%d' % itemsize)).max)
+        if rows * cols * bins == 0:
+            # Header-only file, nothing to map
+            self.counts = np.zeros((rows, cols, bins), dtype=self.dtype)
+        else:
+            self.counts = np.memmap(path, dtype=self.dtype, mode='r', offset=DATA_OFFSET, shape=(rows, cols, bins))
+
+    def tile(self, i, j):
+        """
+        Return/Output: int64 counts of tile (i, j), only that tile is read
+        """
+        return np.asarray(self.counts[i, j], dtype=np.int64)
+
+    def flat(self):
+        """
+        Return/Output: all counts as the flat float64 array histogram() returns
+        """
+        return np.asarray(self.counts, dtype=np.float64).reshape(-1)
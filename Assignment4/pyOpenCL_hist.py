@@ -1,50 +1,55 @@
 import time
+import zlib
 import argparse
+import multiprocessing
 from tabulate import tabulate
 
 import pyopencl as cl
 import pyopencl.array
 from pyopencl.clmath import floor
-import histograms
+from hist_layout import BinLayout, CL_BIN_FUNCTION, histogramLayout
+from hist_index import HistogramIndex, HistogramPyramid, indexPath
+from hist_store import HistResultFile, writeHistResult
 
 import numpy as np
 import os
 os.environ['PYOPENCL_COMPILER_OUTPUT'] = '1'
 
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.buffer_pool import get_pool
+from common.cl_runtime import get_runtime, setup_CL
+from common.program_cache import build_kernel, define_options
+
 import matplotlib as mpl
 mpl.use('agg')
 import matplotlib.pyplot as plt
 
 import pdb
 
-def setup_CL():
-    """
-    Sets up openCL platform devices,
-        context, and CommandQueue
-
-    Returns: list of device, context, CommandQueue
-    """
-
-    #Set up openCL platform
-    # NAME = 'NVIDIA CUDA'
-    platforms = cl.get_platforms()
+# Host<->device bytes moved by the last call of each openCL histogram function
+transferBytes = {}
 
-    dev = None
-    for p in platforms:
-        #Easy switching for local vs remote machine
-        if p.name == 'Apple':
-            # NAME = 'Apple'
-            dev = [p.get_devices()[1]]
-        elif p.name == 'NVIDIA CUDA':
-            dev = p.get_devices()
+# Stage timing of the last histPipelined call (seconds, overlap ratio)
+pipelineStats = {}
 
-    # Command queue, enable GPU profiling
-    ctx = cl.Context(dev)
-    queue = cl.CommandQueue(ctx,properties=cl.command_queue_properties.PROFILING_ENABLE)
-
-    return [dev,ctx,queue]
-
-def histOpt(histogramValues):
+def histInputType(dtype):
+    """
+    Pick the openCL element type for histogram input
+        -> uint8/uint16 are shipped to the device as-is (uchar/ushort)
+        -> anything else is widened to int
+    Input:
+        variable dtype: numpy dtype of the input
+    Return/Output: [openCL type name, numpy dtype]
+    """
+    dtype = np.dtype(dtype)
+    if dtype == np.uint8:
+        return ['uchar', dtype]
+    if dtype == np.uint16:
+        return ['ushort', dtype]
+    return ['int', np.dtype(np.int32)]
+
+def histOpt(histogramValues, layout=None):
     """
     Generate histogram with opt kernel
         -> tiling
@@ -53,18 +58,20 @@ def histOpt(histogramValues):
         -> coalesced memory access through warp multiple block size
     Input:
         variable histogramValues: 1-d array with values for histogram
+        variable layout: BinLayout (None -> the 18 bins of histogram())
     Return/Output: [hist, runtime]
     """
 
     #Setup openCL
     dev, ctx, queue = setup_CL()
+    pool = get_pool(queue)
 
     #openCL Kernel
     #Optimized Histogram
     kernel_code = """
-    #define BINS {}
-
-    __kernel void func(__global int* histInput, __global int* histOutput) {{
+    #define INPUT_TYPE {}
+    {}
+    __kernel void func(__global INPUT_TYPE* histInput, __global int* histOutput, __global const int* binLut) {{
 
         __local int localHist[BINS];
 
@@ -73,22 +80,21 @@ def histOpt(histogramValues):
         int x = bx * get_local_size(0) + tx;
 
         //Initialize bins to 0
-        if (tx < BINS) {{
-            localHist[tx] = 0;
+        for (int b = tx; b < BINS; b += get_local_size(0)) {{
+            localHist[b] = 0;
         }}
         barrier(CLK_LOCAL_MEM_FENCE);
 
-        //Calculate local
-        int loc = (int) (histInput[x]/10);
-        atomic_add( &(localHist[loc]), 1);
+        //Calculate local, values outside the layout are dropped
+        int loc = binOf((int) histInput[x], binLut);
+        if (loc >= 0) {{
+            atomic_add( &(localHist[loc]), 1);
+        }}
         barrier(CLK_LOCAL_MEM_FENCE);
 
         //Store to global
-        if (tx < BINS) {{
-            //printf("Thread: %d, histOutput[%d] = %d, localHist[tx] = %d\\n", x, tx, histOutput[tx], localHist[tx]);
-            atomic_add( &(histOutput[tx]), localHist[tx] );
-            //printf("Thread: %d, histOutput[%d] = %d, localHist[tx] = %d\\n", x, tx, histOutput[tx], localHist[tx]);
-
+        for (int b = tx; b < BINS; b += get_local_size(0)) {{
+            atomic_add( &(histOutput[b]), localHist[b] );
         }}
     }}
     """
@@ -97,22 +103,30 @@ def histOpt(histogramValues):
     histogramValues_row_size = histogramValues.shape[0]
     histogramValues_col_size = histogramValues.shape[1]
     histogramValues_val_count = 1024*1024
+    layout = layout or BinLayout.default()
+    inputType, inputDtype = histInputType(histogramValues.dtype)
+    nbins = layout.bins
 
     WORKGROUP_SIZE = 128
 
     # update template with current runtime requirements
-    kernel = kernel_code.format(18)
+    kernel = kernel_code.format(inputType, CL_BIN_FUNCTION)
 
     # Compile kernel
-    prg = cl.Program(ctx, kernel).build()
+    knl = build_kernel(ctx, kernel, define_options(**layout.clDefines()))
 
     # Set up loop data
     base = np.power(2, 10).astype(np.int32)
-    side = int(data.shape[0] / base)
+    side = int(histogramValues.shape[0] / base)
     binCount = side**2
-    histResult = np.zeros((binCount, 18))
+    histResult = np.zeros((binCount, nbins))
     histResult = histResult.reshape(-1).astype(np.int32)
 
+    # Device buffers are reused for every tile
+    histogramValues_gpu = cl.array.empty(queue, (base, base), inputDtype, allocator=pool)
+    hist = cl.array.empty(queue, (nbins), np.int32, allocator=pool)
+    binLut_gpu = cl.array.to_device(queue, layout.clLut(), allocator=pool)
+
     # print(histResult.shape)
 
     # Iterate over each 1024x1024 dataset
@@ -121,20 +135,22 @@ def histOpt(histogramValues):
         for j in range(side):
 
             #Move data to device
-            histogramValues_int = np.array(histogramValues[i*base:(i+1)*base, j*base:(j+1)*base]).astype(np.int32)
-            histogramValues_gpu = cl.array.to_device(queue, histogramValues_int)
-            hist = cl.array.zeros(queue, (18), np.int32)
+            # No host copy when the tile is already contiguous in the input dtype
+            histogramValues_in = np.ascontiguousarray(histogramValues[i*base:(i+1)*base, j*base:(j+1)*base], dtype=inputDtype)
+            histogramValues_gpu.set(histogramValues_in)
+            hist.fill(0)
 
             #Launch kernel and time it
             #Set global ID, workItems, workGroups
-            event = prg.func(queue, (histogramValues_val_count,1,1),(WORKGROUP_SIZE,1,1), histogramValues_gpu.data, hist.data)
+            event = knl(queue, (histogramValues_val_count,1,1),(WORKGROUP_SIZE,1,1), histogramValues_gpu.data, hist.data, binLut_gpu.data)
 
 
             #Save output
             bin_idx = i * side + j
             # print("Got to end of iter %d" % j)
-            histResult[bin_idx*18:bin_idx*18+18] = hist.get()
+            histResult[bin_idx*nbins:(bin_idx+1)*nbins] = hist.get()
     runtime = time.time()-start
+    transferBytes['histOpt'] = side**2 * (histogramValues_gpu.nbytes + hist.nbytes)
 
     # print('openCL_opt2 %d x %d transpose-mult time:  %.2E' % (histogramValues.shape[0], histogramValues.shape[1], runtime))
     # print('openCL_opt2_transposed==goldenTransposed: %s' % np.allclose(transposed, np.transpose(histogramValues)))
@@ -150,7 +166,7 @@ def histOpt(histogramValues):
 
     return [histResult, runtime]
 
-def histNaive(histogramValues):
+def histNaive(histogramValues, layout=None):
     """
     Generate histogram with naive kernel
         -> no tiling
@@ -158,28 +174,30 @@ def histNaive(histogramValues):
         -> no reduction
     Input:
         variable histogramValues: 1-d array with values for histogram
+        variable layout: BinLayout (None -> the 18 bins of histogram())
     Return/Output: [hist, runtime]
     """
 
     #Setup openCL
     dev, ctx, queue = setup_CL()
+    pool = get_pool(queue)
 
     #openCL Kernel
     #Optimized Histogram
     kernel_code = """
-    #define BINS {}
-
-    __kernel void func(__global int* histInput, __global int* histOutput) {{
+    #define INPUT_TYPE {}
+    {}
+    __kernel void func(__global INPUT_TYPE* histInput, __global int* histOutput, __global const int* binLut) {{
 
         int bx = get_group_id(0);
         int tx = get_local_id(0);
         int x = bx * get_local_size(0) + tx;
 
-        //Calculate local
-        int loc = (int)(histInput[x]/10);
+        //Calculate local, values outside the layout are dropped
+        int loc = binOf((int) histInput[x], binLut);
 
         //Store to global
-        if (tx < BINS) {{
+        if (loc >= 0) {{
             atomic_add( &(histOutput[loc]), 1 );
         }}
     }}
@@ -189,22 +207,30 @@ def histNaive(histogramValues):
     histogramValues_row_size = histogramValues.shape[0]
     histogramValues_col_size = histogramValues.shape[1]
     histogramValues_val_count = 1024*1024
+    layout = layout or BinLayout.default()
+    inputType, inputDtype = histInputType(histogramValues.dtype)
+    nbins = layout.bins
 
     WORKGROUP_SIZE = 2
 
     # update template with current runtime requirements
-    kernel = kernel_code.format(18)
+    kernel = kernel_code.format(inputType, CL_BIN_FUNCTION)
 
     # Compile kernel
-    prg = cl.Program(ctx, kernel).build()
+    knl = build_kernel(ctx, kernel, define_options(**layout.clDefines()))
 
     # Set up loop data
     base = np.power(2, 10).astype(np.int32)
-    side = int(data.shape[0] / base)
+    side = int(histogramValues.shape[0] / base)
     binCount = side**2
-    histResult = np.zeros((binCount, 18))
+    histResult = np.zeros((binCount, nbins))
     histResult = histResult.reshape(-1).astype(np.int32)
 
+    # Device buffers are reused for every tile
+    histogramValues_gpu = cl.array.empty(queue, (base, base), inputDtype, allocator=pool)
+    hist = cl.array.empty(queue, (nbins), np.int32, allocator=pool)
+    binLut_gpu = cl.array.to_device(queue, layout.clLut(), allocator=pool)
+
     # print(histResult.shape)
 
     # Iterate over each 1024x1024 dataset
@@ -213,21 +239,23 @@ def histNaive(histogramValues):
         for j in range(side):
 
             #Move data to device
-            histogramValues_int = np.array(histogramValues[i*base:(i+1)*base, j*base:(j+1)*base]).astype(np.int32)
-            histogramValues_gpu = cl.array.to_device(queue, histogramValues_int)
-            hist = cl.array.zeros(queue, (18), np.int32)
+            # No host copy when the tile is already contiguous in the input dtype
+            histogramValues_in = np.ascontiguousarray(histogramValues[i*base:(i+1)*base, j*base:(j+1)*base], dtype=inputDtype)
+            histogramValues_gpu.set(histogramValues_in)
+            hist.fill(0)
 
             #Launch kernel and time it
             #Set global ID, workItems, workGroups
-            event = prg.func(queue, (histogramValues_val_count,1,1),(WORKGROUP_SIZE,1,1), histogramValues_gpu.data, hist.data)
+            event = knl(queue, (histogramValues_val_count,1,1),(WORKGROUP_SIZE,1,1), histogramValues_gpu.data, hist.data, binLut_gpu.data)
 
 
             #Save output
             bin_idx = i * side + j
             # print("Got to end of iter %d" % j)
-            histResult[bin_idx*18:bin_idx*18+18] = hist.get()
+            histResult[bin_idx*nbins:(bin_idx+1)*nbins] = hist.get()
             # print(histResult[bin_idx*18:bin_idx*18+18])
     runtime = time.time()-start
+    transferBytes['histNaive'] = side**2 * (histogramValues_gpu.nbytes + hist.nbytes)
 
     # print('openCL_opt2 %d x %d transpose-mult time:  %.2E' % (histogramValues.shape[0], histogramValues.shape[1], runtime))
     # print('openCL_opt2_transposed==goldenTransposed: %s' % np.allclose(transposed, np.transpose(histogramValues)))
@@ -245,6 +273,688 @@ def histNaive(histogramValues):
 
 
     pass
+
+def histStrip(histogramValues, exponent=10, stripBytes=2**28, layout=None):
+    """
+    Generate all tile histograms with one launch per image strip
+        -> each launch covers many 2^exponent x 2^exponent tiles
+        -> shared memory histogram per work-group (groups never straddle tiles)
+        -> per-tile bins accumulated in one (tiles, bins) device buffer
+        -> single readback at the end
+        -> any BinLayout, division-free bin lookup, out-of-range values never
+           index past the local histogram
+    Input:
+        variable histogramValues: 2-d array with values for histogram
+        variable exponent: sub-region size is 2^exponent by 2^exponent
+        variable stripBytes: upper bound on the device strip buffer
+        variable layout: BinLayout (None -> the 18 bins of histogram())
+    Return/Output: [hist, runtime]
+    """
+
+    start = time.time()
+    hist, uploadBytes = _histStripDevice(histogramValues, exponent, stripBytes, layout)
+
+    #Save output
+    histResult = hist.get()
+    runtime = time.time()-start
+    transferBytes['histStrip'] = uploadBytes + hist.nbytes
+
+    return [histResult, runtime]
+
+def _histStripDevice(histogramValues, exponent, stripBytes, layout):
+    """
+    histStrip() without the readback
+    Return/Output: [device (rowTiles*colTiles*bins) int32 array, bytes uploaded]
+    """
+
+    #Setup openCL
+    dev, ctx, queue = setup_CL()
+    pool = get_pool(queue)
+
+    #openCL Kernel
+    #Multi-tile Histogram
+    kernel_code = """
+    #define INPUT_TYPE {}
+    {}
+    __kernel void func(__global INPUT_TYPE* histInput, __global int* histOutput,
+                       const int width, const int base, const int tileRowOffset,
+                       __global const int* binLut) {{
+
+        __local int localHist[BINS];
+
+        int tx = get_local_id(0);
+        int col = get_global_id(0);
+        int row = get_global_id(1);
+        int tile = (tileRowOffset + row/base) * (width/base) + col/base;
+
+        //Initialize bins to 0
+        for (int b = tx; b < BINS; b += get_local_size(0)) {{
+            localHist[b] = 0;
+        }}
+        barrier(CLK_LOCAL_MEM_FENCE);
+
+        //Calculate local, dropped values return -1
+        int loc = binOf((int) histInput[(size_t)row*width + col], binLut);
+        if (loc >= 0) {{
+            atomic_add( &(localHist[loc]), 1);
+        }}
+        barrier(CLK_LOCAL_MEM_FENCE);
+
+        //Store to this tile's bins in global
+        for (int b = tx; b < BINS; b += get_local_size(0)) {{
+            atomic_add( &(histOutput[tile*BINS + b]), localHist[b] );
+        }}
+    }}
+    """
+
+    # Pre-calculate values used across all threads
+    layout = layout or BinLayout.default()
+    inputType, inputDtype = histInputType(histogramValues.dtype)
+    base = int(np.power(2, exponent))
+    rowTiles = int(histogramValues.shape[0] / base)
+    colTiles = int(histogramValues.shape[1] / base)
+    width = colTiles * base
+
+    # Work-groups must not straddle tiles
+    WORKGROUP_SIZE = min(128, base)
+
+    # Strip = whole tile rows, bounded by stripBytes and the device alloc limit
+    maxBytes = min(stripBytes, dev[0].max_mem_alloc_size)
+    stripTileRows = int(max(1, min(rowTiles, maxBytes // (inputDtype.itemsize * base * width))))
+
+    # update template with current runtime requirements
+    kernel = kernel_code.format(inputType, CL_BIN_FUNCTION)
+
+    # Compile kernel, bin layout baked in as constants
+    knl = build_kernel(ctx, kernel, define_options(**layout.clDefines()))
+
+    # Device buffers: one strip, all tile bins
+    strip_gpu = cl.array.empty(queue, (stripTileRows * base, width), inputDtype, allocator=pool)
+    hist = cl.array.zeros(queue, (rowTiles * colTiles * layout.bins), np.int32, allocator=pool)
+    binLut_gpu = cl.array.to_device(queue, layout.clLut(), allocator=pool)
+
+    # Iterate over strips of whole tile rows
+    uploadBytes = 0
+    for t in range(0, rowTiles, stripTileRows):
+        tileRows = min(stripTileRows, rowTiles - t)
+        rows = tileRows * base
+
+        #Move data to device
+        #Whole rows of a memmap are contiguous: zero-copy view straight to the device
+        histogramValues_in = np.ascontiguousarray(histogramValues[t*base:t*base+rows, :width], dtype=inputDtype)
+        cl.enqueue_copy(queue, strip_gpu.data, histogramValues_in)
+        uploadBytes += histogramValues_in.nbytes
+
+        #Launch kernel
+        #Set global ID, workItems, workGroups
+        knl(queue, (width, rows), (WORKGROUP_SIZE, 1), strip_gpu.data, hist.data,
+            np.int32(width), np.int32(base), np.int32(t), binLut_gpu.data)
+
+    return [hist, uploadBytes]
+
+def histPyramid(histogramValues, finest=8, coarsest=10, stripBytes=2**28, layout=None):
+    """
+    Generate tile histograms at every tile size from 2^finest to 2^coarsest
+        -> one histStrip pass over the data at the finest tile size
+        -> each coarser level is a 2x2 sum of the level below, on the device
+        -> the image is read once no matter how many levels are requested
+    Input:
+        variable histogramValues: 2-d array with values for histogram
+        variable finest, coarsest: exponents of the smallest and largest tile size
+        variable stripBytes: upper bound on the device strip buffer
+        variable layout: BinLayout (None -> the 18 bins of histogram())
+    Return/Output: [HistogramPyramid, runtime]
+    """
+
+    #Setup openCL
+    dev, ctx, queue = setup_CL()
+    pool = get_pool(queue)
+
+    #openCL Kernel
+    #2x2 tile reduction, one work-item per (bin, coarse tile)
+    kernel_code = """
+    __kernel void func(__global const int* fine, __global int* coarse, const int fineCols, const int coarseCols) {
+        int b = get_global_id(0);
+        int c = get_global_id(1);
+        int r = get_global_id(2);
+
+        size_t f = ((size_t)(2*r) * fineCols + 2*c) * BINS + b;
+        size_t down = (size_t)fineCols * BINS;
+        coarse[((size_t)r * coarseCols + c) * BINS + b] = fine[f] + fine[f + BINS] + fine[f + down] + fine[f + down + BINS];
+    }
+    """
+
+    if coarsest < finest:
+        raise Exception('coarsest must be >= finest, but get {} < {}'.format(coarsest, finest))
+    layout = layout or BinLayout.default()
+    nbins = layout.bins
+    knl = build_kernel(ctx, kernel_code, define_options(BINS=nbins))
+
+    start = time.time()
+    fine, uploadBytes = _histStripDevice(histogramValues, finest, stripBytes, layout)
+    rows = int(histogramValues.shape[0] / 2**finest)
+    cols = int(histogramValues.shape[1] / 2**finest)
+    levels = {finest: fine.get().reshape(rows, cols, nbins)}
+    readBytes = fine.nbytes
+
+    for e in range(finest + 1, coarsest + 1):
+        coarseRows, coarseCols = rows // 2, cols // 2
+        coarse = cl.array.empty(queue, (coarseRows * coarseCols * nbins), np.int32, allocator=pool)
+        if coarse.size:
+            knl(queue, (nbins, coarseCols, coarseRows), None, fine.data, coarse.data,
+                np.int32(cols), np.int32(coarseCols))
+        levels[e] = coarse.get().reshape(coarseRows, coarseCols, nbins)
+        readBytes += coarse.nbytes
+        fine, rows, cols = coarse, coarseRows, coarseCols
+    runtime = time.time()-start
+    transferBytes['histPyramid'] = uploadBytes + readBytes
+
+    return [HistogramPyramid(levels, layout), runtime]
+
+def _percentileScale(percentiles):
+    ## Percentiles as integers in units of 1e-4 %, so ranks are exact integer arithmetic
+    q = np.round(np.asarray(percentiles, dtype=np.float64) * 10000).astype(np.int64)
+    if np.any(q < 0) or np.any(q > 1000000):
+        raise Exception('percentiles must be in [0, 100], but get {}'.format(percentiles))
+    return q
+
+def histStats(histogramValues, percentiles=(25, 50, 75), exponent=10, layout=None):
+    """
+    Per-tile summary statistics computed on the device
+        -> tile histograms from one histStrip pass stay on the device
+        -> one work-item per tile scans its bins in registers (inclusive
+           prefix sum) for the mean, mode bin and every percentile bin
+        -> only tiles-sized summaries are read back, not tiles*bins counts
+    Input:
+        variable histogramValues: 2-d array with values for histogram
+        variable percentiles: percentiles in [0, 100]
+        variable exponent: sub-region size is 2^exponent by 2^exponent
+        variable layout: BinLayout (None -> the 18 bins of histogram())
+    Return/Output: [stats, runtime], stats as histStatsReference()
+    """
+
+    #Setup openCL
+    dev, ctx, queue = setup_CL()
+    layout = layout or BinLayout.default()
+
+    start = time.time()
+    hist, uploadBytes = _histStripDevice(histogramValues, exponent, 2**28, layout)
+    tiles = hist.size // layout.bins
+    stats, readBytes = histStatsDevice(queue, hist, tiles, percentiles, layout)
+    runtime = time.time()-start
+    transferBytes['histStats'] = uploadBytes + readBytes
+
+    return [stats, runtime]
+
+def histStatsDevice(queue, hist, tiles, percentiles=(25, 50, 75), layout=None):
+    """
+    Summaries of tile histograms already on the device
+    Input:
+        variable queue: CommandQueue owning hist
+        variable hist: device int32 array of tiles*bins counts (histStrip layout)
+        variable tiles: number of tiles in hist
+        variable percentiles: percentiles in [0, 100]
+        variable layout: BinLayout of the counts
+    Return/Output: [stats, bytes read back]
+    """
+
+    pool = get_pool(queue)
+
+    #openCL Kernel
+    #Tile statistics, percentile p of a tile is the first bin whose inclusive
+    #prefix count reaches ceil(p/100 * total), p is scaled by 1e4
+    kernel_code = """
+    __kernel void func(__global const int* hist, __constant float* centers, __constant long* pctScaled,
+                       __global float* mean, __global int* mode, __global int* pct, __global long* total, const int tiles) {
+        int t = get_global_id(0);
+        if (t >= tiles) return;
+
+        __global const int* h = hist + (size_t)t * BINS;
+        long cum[BINS];
+        long run = 0;
+        float weighted = 0.0f;
+        int best = -1;
+        int bestCount = 0;
+
+        //Prefix scan, weighted sum and mode in one pass over the bins
+        for (int b = 0; b < BINS; ++b) {
+            int c = h[b];
+            run += c;
+            cum[b] = run;
+            weighted += c * centers[b];
+            if (c > bestCount) {
+                bestCount = c;
+                best = b;
+            }
+        }
+        total[t] = run;
+        mode[t] = best;
+        mean[t] = run ? weighted / run : NAN;
+
+        for (int p = 0; p < NPCT; ++p) {
+            long rank = max((pctScaled[p] * run + 999999) / 1000000, 1L);
+            int bin = -1;
+            if (run) {
+                for (bin = 0; cum[bin] < rank; ++bin);
+            }
+            pct[(size_t)t * NPCT + p] = bin;
+        }
+    }
+    """
+
+    layout = layout or BinLayout.default()
+    q = _percentileScale(percentiles)
+    knl = build_kernel(queue.context, kernel_code, define_options(BINS=layout.bins, NPCT=max(1, len(q))))
+
+    centers = ((layout.edges[:-1] + layout.edges[1:]) / 2).astype(np.float32)
+    centers_gpu = cl.array.to_device(queue, centers, allocator=pool)
+    pct_gpu = cl.array.to_device(queue, q if len(q) else np.zeros(1, dtype=np.int64), allocator=pool)
+    mean = cl.array.empty(queue, (tiles,), np.float32, allocator=pool)
+    mode = cl.array.empty(queue, (tiles,), np.int32, allocator=pool)
+    pct = cl.array.empty(queue, (tiles, max(1, len(q))), np.int32, allocator=pool)
+    total = cl.array.empty(queue, (tiles,), np.int64, allocator=pool)
+
+    knl(queue, (tiles,), None, hist.data, centers_gpu.data, pct_gpu.data,
+        mean.data, mode.data, pct.data, total.data, np.int32(tiles))
+
+    stats = {'mean': mean.get(), 'mode': mode.get(), 'percentiles': pct.get()[:, :len(q)], 'total': total.get()}
+    readBytes = mean.nbytes + mode.nbytes + pct.nbytes + total.nbytes
+    return [stats, readBytes]
+
+def histPipelined(histogramValues, exponent=10, depth=2, layout=None):
+    """
+    Generate tile histograms with a pipelined upload/compute/readback executor
+        -> separate in-order queues for upload, compute and readback
+        -> depth pinned (ALLOC_HOST_PTR) staging buffers, non-blocking copies
+        -> tile N+1 uploads while tile N computes and tile N-1 reads back
+        -> overlap ratio from profiling events: 1 - device-active time / sum of stage times
+           (0 = fully serialized, 2/3 = three equal stages perfectly overlapped)
+    Input:
+        variable histogramValues: 2-d array with values for histogram
+        variable exponent: sub-region size is 2^exponent by 2^exponent
+        variable depth: number of tiles in flight (staging buffers per stage)
+        variable layout: BinLayout (None -> the 18 bins of histogram())
+    Return/Output: [hist, runtime]
+    """
+
+    #Setup openCL
+    dev, ctx, queue = setup_CL()
+    runtime_cl = get_runtime()
+    uploadQueue = runtime_cl.get_queue('upload')
+    computeQueue = runtime_cl.get_queue('compute')
+    readbackQueue = runtime_cl.get_queue('readback')
+    pool = get_pool(queue)
+
+    #openCL Kernel
+    #Optimized Histogram, writes to its tile's slot of the output
+    kernel_code = """
+    #define INPUT_TYPE {}
+    {}
+    __kernel void func(__global INPUT_TYPE* histInput, __global int* histOutput, const int tile,
+                       __global const int* binLut) {{
+
+        __local int localHist[BINS];
+
+        int tx = get_local_id(0);
+        int x = get_global_id(0);
+
+        //Initialize bins to 0
+        for (int b = tx; b < BINS; b += get_local_size(0)) {{
+            localHist[b] = 0;
+        }}
+        barrier(CLK_LOCAL_MEM_FENCE);
+
+        //Calculate local
+        int loc = binOf((int) histInput[x], binLut);
+        if (loc >= 0) {{
+            atomic_add( &(localHist[loc]), 1);
+        }}
+        barrier(CLK_LOCAL_MEM_FENCE);
+
+        //Store to global
+        for (int b = tx; b < BINS; b += get_local_size(0)) {{
+            atomic_add( &(histOutput[tile*BINS + b]), localHist[b] );
+        }}
+    }}
+    """
+
+    # Pre-calculate values used across all threads
+    layout = layout or BinLayout.default()
+    inputType, inputDtype = histInputType(histogramValues.dtype)
+    base = int(np.power(2, exponent))
+    side = int(histogramValues.shape[0] / base)
+    tiles = side**2
+    nbins = layout.bins
+    WORKGROUP_SIZE = min(128, base*base)
+
+    # update template with current runtime requirements
+    kernel = kernel_code.format(inputType, CL_BIN_FUNCTION)
+
+    # Compile kernel
+    knl = build_kernel(ctx, kernel, define_options(**layout.clDefines()))
+
+    # Pinned host staging + device input per slot, one output for all tiles
+    mf = cl.mem_flags
+    nbytes = base * base * inputDtype.itemsize
+    staging = []
+    for k in range(depth):
+        pinned = cl.Buffer(ctx, mf.READ_ONLY | mf.ALLOC_HOST_PTR, nbytes)
+        host, _ = cl.enqueue_map_buffer(queue, pinned, cl.map_flags.WRITE, 0, (base, base), inputDtype)
+        staging.append((pinned, host))
+    inputs = [cl.array.empty(queue, (base, base), inputDtype, allocator=pool) for k in range(depth)]
+    hist = cl.array.zeros(queue, (tiles * nbins), np.int32, allocator=pool)
+    binLut_gpu = cl.array.to_device(queue, layout.clLut(), allocator=pool)
+    queue.finish()
+    histResult = np.zeros(tiles * nbins, dtype=np.int32)
+
+    uploads = [None] * depth
+    computes = [None] * depth
+    events = []
+
+    start = time.time()
+    for n in range(tiles):
+        i, j = divmod(n, side)
+        slot = n % depth
+        pinned, host = staging[slot]
+
+        # Host may refill the staging slot once its previous upload is done
+        if uploads[slot] is not None:
+            uploads[slot].wait()
+        np.copyto(host, histogramValues[i*base:(i+1)*base, j*base:(j+1)*base], casting='unsafe')
+
+        # Upload waits for the previous compute on this slot's device buffer
+        wait = [computes[slot]] if computes[slot] is not None else None
+        uploads[slot] = cl.enqueue_copy(uploadQueue, inputs[slot].data, host, is_blocking=False, wait_for=wait)
+
+        knl.set_args(inputs[slot].data, hist.data, np.int32(n), binLut_gpu.data)
+        computes[slot] = cl.enqueue_nd_range_kernel(computeQueue, knl, (base*base,), (WORKGROUP_SIZE,),
+                                                    wait_for=[uploads[slot]])
+
+        readback = cl.enqueue_copy(readbackQueue, histResult[n*nbins:(n+1)*nbins], hist.data,
+                                   src_offset=n*nbins*4, is_blocking=False, wait_for=[computes[slot]])
+        events.append((uploads[slot], computes[slot], readback))
+
+    readbackQueue.finish()
+    runtime = time.time()-start
+
+    for pinned, host in staging:
+        host.base.release(queue)
+
+    # Overlap from device timestamps: stage time hidden behind other stages
+    intervals = sorted((evt.profile.start, evt.profile.end) for stage in events for evt in stage)
+    busy = sum(end - begin for begin, end in intervals)
+    active = 0
+    curStart, curEnd = intervals[0]
+    for begin, end in intervals[1:]:
+        if begin > curEnd:
+            active += curEnd - curStart
+            curStart, curEnd = begin, end
+        else:
+            curEnd = max(curEnd, end)
+    active += curEnd - curStart
+    pipelineStats['overlap'] = 1 - float(active) / busy if busy else 0.0
+    pipelineStats['active'] = 1e-9 * active
+    pipelineStats['busy'] = 1e-9 * busy
+    transferBytes['histPipelined'] = tiles * nbytes + histResult.nbytes
+
+    return [histResult, runtime]
+
+def histPrivatized(histogramValues, exponent=10, copies=8, items=8, layout=None):
+    """
+    Generate histogram with privatized/aggregated kernel
+        -> several private copies of the local histogram per work-group,
+           chosen by lane id, so hot bins are spread over COPIES addresses
+        -> each work-item bins ITEMS coalesced elements and merges runs of
+           equal bins into one atomic (skewed data mostly hits 2-3 bins)
+        -> copies merged once per work-group, one global atomic per bin
+    Input:
+        variable histogramValues: 2-d array with values for histogram
+        variable exponent: sub-region size is 2^exponent by 2^exponent
+        variable copies: private local histograms per work-group
+        variable items: elements per work-item
+        variable layout: BinLayout (None -> the 18 bins of histogram())
+    Return/Output: [hist, runtime]
+    """
+
+    #Setup openCL
+    dev, ctx, queue = setup_CL()
+    pool = get_pool(queue)
+
+    #openCL Kernel
+    #Privatized Histogram
+    kernel_code = """
+    #define INPUT_TYPE {}
+    #define COPIES {}
+    #define ITEMS {}
+    {}
+    __kernel void func(__global INPUT_TYPE* histInput, __global int* histOutput, __global const int* binLut) {{
+
+        //Padded rows keep the copies on different banks
+        __local int localHist[COPIES][BINS + 1];
+
+        int tx = get_local_id(0);
+        int lsize = get_local_size(0);
+        int copy = tx % COPIES;
+        size_t first = (size_t)get_group_id(0) * ITEMS * lsize + tx;
+
+        //Initialize bins to 0
+        for (int b = tx; b < COPIES * (BINS + 1); b += lsize) {{
+            ((__local int*)localHist)[b] = 0;
+        }}
+        barrier(CLK_LOCAL_MEM_FENCE);
+
+        //Calculate local, one atomic per run of equal bins
+        int prev = -1;
+        int run = 0;
+        for (int k = 0; k < ITEMS; ++k) {{
+            int loc = binOf((int) histInput[first + (size_t)k * lsize], binLut);
+            if (loc == prev) {{
+                ++run;
+            }} else {{
+                if (prev >= 0) {{
+                    atomic_add( &(localHist[copy][prev]), run);
+                }}
+                prev = loc;
+                run = 1;
+            }}
+        }}
+        if (prev >= 0) {{
+            atomic_add( &(localHist[copy][prev]), run);
+        }}
+        barrier(CLK_LOCAL_MEM_FENCE);
+
+        //Merge copies, store to global
+        for (int b = tx; b < BINS; b += lsize) {{
+            int sum = 0;
+            for (int c = 0; c < COPIES; ++c) {{
+                sum += localHist[c][b];
+            }}
+            atomic_add( &(histOutput[b]), sum );
+        }}
+    }}
+    """
+
+    # Pre-calculate values used across all threads
+    layout = layout or BinLayout.default()
+    inputType, inputDtype = histInputType(histogramValues.dtype)
+    base = int(np.power(2, exponent))
+    side = int(histogramValues.shape[0] / base)
+    nbins = layout.bins
+
+    WORKGROUP_SIZE = min(128, base*base)
+    items = int(max(1, min(items, base*base // WORKGROUP_SIZE)))
+    # Every work-group covers WORKGROUP_SIZE*ITEMS elements of the tile exactly
+    if (base*base) % (WORKGROUP_SIZE*items):
+        raise Exception('items must divide {} (a power of two), but get {}'.format(base*base // WORKGROUP_SIZE, items))
+    globalSize = base*base // items
+
+    # update template with current runtime requirements
+    kernel = kernel_code.format(inputType, copies, items, CL_BIN_FUNCTION)
+
+    # Compile kernel
+    knl = build_kernel(ctx, kernel, define_options(**layout.clDefines()))
+
+    # Device buffers are reused for every tile
+    histResult = np.zeros(side**2 * nbins, dtype=np.int32)
+    histogramValues_gpu = cl.array.empty(queue, (base, base), inputDtype, allocator=pool)
+    hist = cl.array.empty(queue, (nbins), np.int32, allocator=pool)
+    binLut_gpu = cl.array.to_device(queue, layout.clLut(), allocator=pool)
+
+    # Iterate over each tile
+    start = time.time()
+    for i in range(side):
+        for j in range(side):
+
+            #Move data to device
+            histogramValues_in = np.ascontiguousarray(histogramValues[i*base:(i+1)*base, j*base:(j+1)*base], dtype=inputDtype)
+            histogramValues_gpu.set(histogramValues_in)
+            hist.fill(0)
+
+            #Launch kernel
+            knl(queue, (globalSize,), (WORKGROUP_SIZE,), histogramValues_gpu.data, hist.data, binLut_gpu.data)
+
+            #Save output
+            bin_idx = i * side + j
+            histResult[bin_idx*nbins:(bin_idx+1)*nbins] = hist.get()
+    runtime = time.time()-start
+    transferBytes['histPrivatized'] = side**2 * (histogramValues_gpu.nbytes + hist.nbytes)
+
+    return [histResult, runtime]
+
+def histCoarsened(histogramValues, exponent=10, items=256, layout=None):
+    """
+    Generate histogram with thread-coarsened kernel
+        -> each work-item bins ITEMS elements through a grid-stride loop of
+           8-wide vector loads (vload8, ushort8 for the uint16 data)
+        -> counts kept in a private array, merged into local memory once
+           per work-item and into global memory once per work-group
+        -> base*base/ITEMS work-items per tile instead of base*base
+    Input:
+        variable histogramValues: 2-d array with values for histogram
+        variable exponent: sub-region size is 2^exponent by 2^exponent
+        variable items: elements per work-item, multiple of 8
+        variable layout: BinLayout (None -> the 18 bins of histogram())
+    Return/Output: [hist, runtime]
+    """
+
+    #Setup openCL
+    dev, ctx, queue = setup_CL()
+    pool = get_pool(queue)
+
+    #openCL Kernel
+    #Coarsened Histogram
+    kernel_code = """
+    #define INPUT_TYPE {}
+    {}
+    #define COUNT(x) {{ int loc = binOf((x), binLut); if (loc >= 0) priv[loc]++; }}
+
+    __kernel void func(__global const INPUT_TYPE* histInput, __global int* histOutput, const int nVec, __global const int* binLut) {{
+
+        __local int localHist[BINS];
+        int priv[BINS];
+
+        int tx = get_local_id(0);
+        int lsize = get_local_size(0);
+
+        //Initialize bins to 0
+        for (int b = 0; b < BINS; ++b) {{
+            priv[b] = 0;
+        }}
+        for (int b = tx; b < BINS; b += lsize) {{
+            localHist[b] = 0;
+        }}
+        barrier(CLK_LOCAL_MEM_FENCE);
+
+        //Grid-stride loop, neighbouring work-items read neighbouring vectors
+        for (int i = get_global_id(0); i < nVec; i += get_global_size(0)) {{
+            int8 v = convert_int8(vload8(i, histInput));
+            COUNT(v.s0) COUNT(v.s1) COUNT(v.s2) COUNT(v.s3)
+            COUNT(v.s4) COUNT(v.s5) COUNT(v.s6) COUNT(v.s7)
+        }}
+
+        //Merge private counts
+        for (int b = 0; b < BINS; ++b) {{
+            if (priv[b]) {{
+                atomic_add( &(localHist[b]), priv[b]);
+            }}
+        }}
+        barrier(CLK_LOCAL_MEM_FENCE);
+
+        //Store to global
+        for (int b = tx; b < BINS; b += lsize) {{
+            atomic_add( &(histOutput[b]), localHist[b] );
+        }}
+    }}
+    """
+
+    # Pre-calculate values used across all threads
+    layout = layout or BinLayout.default()
+    inputType, inputDtype = histInputType(histogramValues.dtype)
+    base = int(np.power(2, exponent))
+    side = int(histogramValues.shape[0] / base)
+    nbins = layout.bins
+
+    if (base*base) % 8 or items % 8:
+        raise Exception('tile size and items must be multiples of 8, but get {} and {}'.format(base*base, items))
+    nVec = base*base // 8
+    WORKGROUP_SIZE = min(128, nVec)
+    groups = max(1, nVec // (WORKGROUP_SIZE * (items // 8)))
+    globalSize = groups * WORKGROUP_SIZE
+
+    # update template with current runtime requirements
+    kernel = kernel_code.format(inputType, CL_BIN_FUNCTION)
+
+    # Compile kernel
+    knl = build_kernel(ctx, kernel, define_options(**layout.clDefines()))
+
+    # Device buffers are reused for every tile
+    histResult = np.zeros(side**2 * nbins, dtype=np.int32)
+    histogramValues_gpu = cl.array.empty(queue, (base, base), inputDtype, allocator=pool)
+    hist = cl.array.empty(queue, (nbins), np.int32, allocator=pool)
+    binLut_gpu = cl.array.to_device(queue, layout.clLut(), allocator=pool)
+
+    # Iterate over each tile
+    start = time.time()
+    for i in range(side):
+        for j in range(side):
+
+            #Move data to device
+            histogramValues_in = np.ascontiguousarray(histogramValues[i*base:(i+1)*base, j*base:(j+1)*base], dtype=inputDtype)
+            histogramValues_gpu.set(histogramValues_in)
+            hist.fill(0)
+
+            #Launch kernel
+            knl(queue, (globalSize,), (WORKGROUP_SIZE,), histogramValues_gpu.data, hist.data, np.int32(nVec), binLut_gpu.data)
+
+            #Save output
+            bin_idx = i * side + j
+            histResult[bin_idx*nbins:(bin_idx+1)*nbins] = hist.get()
+    runtime = time.time()-start
+    transferBytes['histCoarsened'] = side**2 * (histogramValues_gpu.nbytes + hist.nbytes)
+
+    return [histResult, runtime]
+
+# openCL histogram kernels selectable by name, all take (histogramValues) -> [hist, runtime]
+HIST_KERNELS = {
+    'naive': histNaive,
+    'opt': histOpt,
+    'privatized': histPrivatized,
+    'coarsened': histCoarsened,
+}
+
+def histByName(name, histogramValues, layout=None):
+    """
+    Run one of the openCL histogram kernels by name
+    Input:
+        variable name: key of HIST_KERNELS
+        variable histogramValues: 2-d array with values for histogram
+        variable layout: BinLayout (None -> the 18 bins of histogram())
+    Return/Output: [hist, runtime]
+    """
+    if name not in HIST_KERNELS:
+        raise Exception('kernel must be one of {}, but get {}'.format(sorted(HIST_KERNELS), name))
+    return HIST_KERNELS[name](histogramValues, layout=layout)
+
 def python_dconv_verify(histogramValues, filterVec, dDim):
     """
     Verify dilated conv of a MxN matrix using correlation
@@ -429,6 +1139,231 @@ def histogram(data, exponent = 10):
     bins = bins.reshape(-1)
     return bins
 
+def tileRowCounts(data, rowStart, rowStop, exponent = 10, chunkElements = 2**16):
+    ## Count rows [rowStart, rowStop) of data into the 18 bins of every tile they touch
+    ## data: A 2-D numpy array (or memmap)
+    ## exponent: exponent of two. The sub-region size is 2^exponet by 2^exponent
+    ## chunkElements: elements binned per vectorized pass, cache-sized temporaries are fastest
+    ## Returns a list of (tile row, (side, 18) int64 counts)
+    ## Rows are viewed as (rows, side, base), values are integer divided by 10 and offset
+    ## by their tile so one np.bincount fills every tile's bins in the pass.
+
+    base = int(np.power(2, exponent))
+    side = int(data.shape[0] / base)
+    rowsPerPass = int(max(1, min(base, chunkElements // max(1, side * base))))
+
+    # Keep the tile-offset add in the data's own dtype when it fits (mixed-dtype
+    # broadcasting is several times slower), bincount wants intp
+    idxType = data.dtype if data.dtype.kind == 'u' and side*18 <= np.iinfo(data.dtype).max else np.intp
+    offsets = (np.arange(side) * 18).astype(idxType).reshape(1, side, 1)
+
+    counts = []
+    for i in range(rowStart // base, (rowStop - 1) // base + 1):
+        tileCounts = np.zeros(side*18, dtype=np.int64)
+        for r in range(max(rowStart, i*base), min(rowStop, (i+1)*base), rowsPerPass):
+            rows = min(rowsPerPass, min(rowStop, (i+1)*base) - r)
+            values = np.asarray(data[r:r+rows, :side*base]).reshape(rows, side, base)
+            idx = (values // 10).astype(idxType)
+            idx += offsets
+            # np.histogram edges: last bin is closed [170, 180], outside [0, 180] is dropped
+            if values.min() < 0 or values.max() >= 180:
+                idx[values == 180] -= 1
+                idx = idx[(values >= 0) & (values <= 180)]
+            tileCounts += np.bincount(idx.ravel().astype(np.intp), minlength=side*18)
+        counts.append((i, tileCounts.reshape(side, 18)))
+    return counts
+
+def histogramVectorized(data, exponent = 10, chunkElements = 2**16):
+    ## Calculate the histogram, same output as histogram() without the per-tile python loop
+    ## data: A 2-D numpy array
+    ## exponent: exponent of two. The sub-region size is 2^exponet by 2^exponent
+    ## chunkElements: elements binned per vectorized pass, cache-sized temporaries are fastest
+
+    base = int(np.power(2, exponent))
+    side = int(data.shape[0] / base)
+    bins = np.zeros((side, side, 18), dtype=np.int64)
+    for i, counts in tileRowCounts(data, 0, side*base, exponent, chunkElements):
+        bins[i] += counts
+    bins = bins.reshape(-1).astype(np.float64)
+    return bins
+
+def histStatsReference(bins, percentiles = (25, 50, 75), layout = None):
+    ## NumPy reference of histStats() over flat tile histograms
+    ## bins: flat tiles*bins counts from any histogram function
+    ## percentiles: percentiles in [0, 100]
+    ## layout: BinLayout of the counts (None -> the 18 bins of histogram())
+    ## Returns dict of per-tile 'mean' (bin centers weighted by count, NaN when empty),
+    ## 'mode' (first fullest bin, -1 when empty), 'percentiles' (tiles, len(percentiles))
+    ## bin indices (first bin whose cumulative count reaches ceil(p/100 * total)) and 'total'
+
+    layout = layout or BinLayout.default()
+    counts = np.asarray(bins).astype(np.int64).reshape(-1, layout.bins)
+    cum = np.cumsum(counts, axis=1)
+    total = cum[:, -1]
+    centers = (layout.edges[:-1] + layout.edges[1:]) / 2
+
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        mean = (counts * centers).sum(axis = 1) / total
+    mode = np.where(total > 0, np.argmax(counts, axis = 1), -1)
+
+    q = _percentileScale(percentiles)
+    rank = np.maximum((q[None, :] * total[:, None] + 999999) // 1000000, 1)
+    pct = (cum[:, None, :] < rank[:, :, None]).sum(axis = 2)
+    pct[total == 0] = -1
+
+    return {'mean': mean, 'mode': mode, 'percentiles': pct, 'total': total}
+
+def _histogramBand(args):
+    ## Worker: attach to the data file, count one row band, drop the mapping
+    path, mode, rowStart, rowStop, exponent, chunkElements = args
+    data = getData(path, mode)
+    counts = tileRowCounts(data, rowStart, rowStop, exponent, chunkElements)
+    del data
+    return counts
+
+def histogramParallel(path, mode = 2, exponent = 10, bandRows = 2**9, processes = None, chunkElements = 2**16):
+    ## Calculate the histogram over a pool of processes, same output as histogram(getData(path, mode))
+    ## path: The path from which we extract data
+    ## mode: data region as in getData()
+    ## exponent: exponent of two. The sub-region size is 2^exponet by 2^exponent
+    ## bandRows: rows per work unit, each worker maps only its band of the file so
+    ##           resident memory per worker is bounded by bandRows * row bytes
+    ## processes: pool size (None -> cpu count)
+    ## Workers memmap the file themselves, only (band, counts) cross process boundaries.
+
+    data = getData(path, mode)
+    base = int(np.power(2, exponent))
+    side = int(data.shape[0] / base)
+    del data
+
+    bands = [(path, mode, r, min(r + bandRows, side*base), exponent, chunkElements)
+             for r in range(0, side*base, bandRows)]
+    bins = np.zeros((side, side, 18), dtype=np.int64)
+    pool = multiprocessing.Pool(processes)
+    try:
+        for counts in pool.imap_unordered(_histogramBand, bands):
+            for i, tileCounts in counts:
+                bins[i] += tileCounts
+    finally:
+        pool.close()
+        pool.join()
+    bins = bins.reshape(-1).astype(np.float64)
+    return bins
+
+def histogramIndex(path, mode = 2, exponent = 10, rebuild = False, processes = None):
+    ## Integral histogram index of getData(path, mode), persisted next to the data file
+    ## path: The path from which we extract data
+    ## mode: data region as in getData()
+    ## exponent: base tile size 2^exponent, queries must align to it (8 -> 256 pixel grid)
+    ## rebuild: ignore a saved index
+    ## A saved index is reused while the data file is unchanged, otherwise the counts are
+    ## recomputed with histogramParallel() and saved for the next run.
+
+    idxPath = indexPath(path, '.m%d.e%d' % (mode, exponent))
+    index = None if rebuild else HistogramIndex.load(idxPath, path)
+    if index is None:
+        counts = histogramParallel(path, mode, exponent, processes = processes)
+        index = HistogramIndex.fromCounts(counts, 2**exponent)
+        index.save(idxPath, path)
+    return index
+
+def tileChecksums(data, exponent = 10, tiles = None):
+    ## CRC32 of every tile's bytes, detects which tiles a patch touched
+    ## data: A 2-D numpy array (or memmap)
+    ## exponent: exponent of two. The sub-region size is 2^exponet by 2^exponent
+    ## tiles: (i, j) pairs to checksum, None for all
+    ## Returns a (side, side) uint32 array, tiles not requested are 0
+
+    base = int(np.power(2, exponent))
+    side = int(data.shape[0] / base)
+    sums = np.zeros((side, side), dtype=np.uint32)
+    if tiles is None:
+        tiles = [(i, j) for i in range(side) for j in range(side)]
+    for i, j in tiles:
+        sums[i, j] = zlib.crc32(np.ascontiguousarray(data[i*base:(i+1)*base, j*base:(j+1)*base]))
+    return sums
+
+def saveHistogram(resultPath, bins, data, exponent = 10):
+    ## Write tile histograms in the compact hist_store format
+    ## resultPath: output file
+    ## bins: flat tiles*18 counts from any histogram function
+    ## data: the 2-D array the counts came from, checksummed into the header
+    ## exponent: exponent of two. The sub-region size is 2^exponet by 2^exponent
+    ## Read back with HistResultFile(resultPath).tile(i, j)
+
+    checksum = zlib.crc32(tileChecksums(data, exponent))
+    return writeHistResult(resultPath, np.asarray(bins).astype(np.int64), 2**exponent, checksum = checksum)
+
+def dirtyTiles(rects, exponent = 10, side = None):
+    ## Tiles overlapped by pixel rectangles
+    ## rects: (rowStart, rowStop, colStart, colStop) pixel rectangles, stops exclusive
+    ## exponent: exponent of two. The sub-region size is 2^exponet by 2^exponent
+    ## side: tiles per side, rectangles are clipped to the grid
+    ## Returns a sorted list of (i, j)
+
+    base = int(np.power(2, exponent))
+    tiles = set()
+    for rowStart, rowStop, colStart, colStop in rects:
+        rows = range(rowStart // base, (rowStop - 1) // base + 1)
+        cols = range(colStart // base, (colStop - 1) // base + 1)
+        tiles.update((i, j) for i in rows for j in cols
+                     if side is None or (0 <= i < side and 0 <= j < side))
+    return sorted(tiles)
+
+def histogramIncremental(path, mode = 2, exponent = 10, dirty = None, checksums = None, resultPath = None, processes = None):
+    ## Bring a persisted histogram of getData(path, mode) up to date after the file was patched
+    ## path: The path from which we extract data
+    ## mode: data region as in getData()
+    ## exponent: exponent of two. The sub-region size is 2^exponet by 2^exponent
+    ## dirty: pixel rectangles (rowStart, rowStop, colStart, colStop) known to have changed
+    ## checksums: (side, side) per-tile CRC32 of the new file, array or .npy path written by the
+    ##            patcher. Without dirty or checksums every tile is re-checksummed, which is
+    ##            still far cheaper than re-binning it
+    ## resultPath: persisted counts + checksums (default next to the data file)
+    ## The first call (or an exponent change) computes everything with histogramParallel().
+    ## Returns [bins as histogram(), {'recomputed': tiles binned, 'reused': tiles kept}]
+
+    resultPath = resultPath or indexPath(path, '.m%d.e%d.tiles' % (mode, exponent))
+    data = getData(path, mode)
+    base = int(np.power(2, exponent))
+    side = int(data.shape[0] / base)
+
+    saved = None
+    if os.path.exists(resultPath):
+        with np.load(resultPath) as f:
+            if f['counts'].shape == (side, side, 18):
+                saved = (f['counts'], f['checksums'])
+
+    if saved is None:
+        counts = histogramParallel(path, mode, exponent, processes = processes)
+        counts = counts.astype(np.int64).reshape(side, side, 18)
+        sums = tileChecksums(data, exponent)
+        recompute = [(i, j) for i in range(side) for j in range(side)]
+    else:
+        counts, sums = saved
+        if dirty is not None:
+            recompute = dirtyTiles(dirty, exponent, side)
+            newSums = tileChecksums(data, exponent, recompute)
+            for i, j in recompute:
+                sums[i, j] = newSums[i, j]
+        else:
+            if checksums is None:
+                newSums = tileChecksums(data, exponent)
+            else:
+                newSums = np.load(checksums) if isinstance(checksums, str) else np.asarray(checksums)
+            recompute = [tuple(t) for t in np.argwhere(newSums != sums)]
+            sums = newSums.astype(np.uint32)
+        for i, j in recompute:
+            counts[i, j] = histogramVectorized(data[i*base:(i+1)*base, j*base:(j+1)*base], exponent)
+
+    tmp = resultPath + '.tmp.npz'
+    np.savez(tmp, counts = counts, checksums = sums)
+    os.replace(tmp, resultPath)
+
+    stats = {'recomputed': len(recompute), 'reused': side**2 - len(recompute)}
+    bins = counts.reshape(-1).astype(np.float64)
+    return [bins, stats]
+
 if __name__=="__main__":
 
     #initialize arrays
@@ -454,6 +1389,14 @@ if __name__=="__main__":
         cpu_Runtime_array.append(cpuTime)
         print('CPU_hist %d x %d time:  %.2E' % (data.shape[0], data.shape[1], cpuTime))
 
+        start = time.time()
+        cpuVecData = histogramVectorized(data, exponent = 10)
+        print('CPU_vectorized_hist %d x %d time:  %.2E, vectorized==CPU: %s' % (data.shape[0], data.shape[1], time.time() - start, np.all(cpuData == cpuVecData)))
+
+        start = time.time()
+        cpuParData = histogramParallel("/opt/data/hist_data.dat", mode=0, exponent = 10)
+        print('CPU_parallel_hist %d x %d time:  %.2E, parallel==CPU: %s' % (data.shape[0], data.shape[1], time.time() - start, np.all(cpuData == cpuParData)))
+
         histNaiveData, histNaiveRuntime = histNaive(data)
         gpu_Naive_array.append(histNaiveData)
         gpu_NaiveRuntime_array.append(histNaiveRuntime)
@@ -462,6 +1405,19 @@ if __name__=="__main__":
         gpu_Opt_array.append(histOptData)
         gpu_OptRuntime_array.append(histOptRuntime)
 
+        histStripData, histStripRuntime = histStrip(data)
+        print('GPU_strip %d x %d time:  %.2E, strip==CPU: %s' % (data.shape[0], data.shape[1], histStripRuntime, np.all(cpuData == histStripData)))
+
+        histPipeData, histPipeRuntime = histPipelined(data)
+        print('GPU_pipelined %d x %d time:  %.2E, pipelined==CPU: %s, overlap: %.2f' % (data.shape[0], data.shape[1], histPipeRuntime, np.all(cpuData == histPipeData), pipelineStats['overlap']))
+
+        histPrivData, histPrivRuntime = histByName('privatized', data)
+        print('GPU_privatized %d x %d time:  %.2E, privatized==CPU: %s' % (data.shape[0], data.shape[1], histPrivRuntime, np.all(cpuData == histPrivData)))
+        histCoarseData, histCoarseRuntime = histByName('coarsened', data)
+        print('GPU_coarsened %d x %d time:  %.2E, coarsened==CPU: %s' % (data.shape[0], data.shape[1], histCoarseRuntime, np.all(cpuData == histCoarseData)))
+        print('Speedup over Naive: opt %.2f, privatized %.2f, coarsened %.2f' % (histNaiveRuntime / histOptRuntime, histNaiveRuntime / histPrivRuntime, histNaiveRuntime / histCoarseRuntime))
+        print('Host<->device bytes: %s' % transferBytes)
+
         CustomHistEqual(cpuData, histNaiveData, histOptData)
         CustomPrintHistogram(histNaiveData)
         CustomPrintHistogram(histOptData)
@@ -478,6 +1434,14 @@ if __name__=="__main__":
         cpu_Runtime_array.append(cpuTime)
         print('CPU_hist %d x %d time:  %.2E' % (data.shape[0], data.shape[1], cpuTime))
 
+        start = time.time()
+        cpuVecData = histogramVectorized(data, exponent = 10)
+        print('CPU_vectorized_hist %d x %d time:  %.2E, vectorized==CPU: %s' % (data.shape[0], data.shape[1], time.time() - start, np.all(cpuData == cpuVecData)))
+
+        start = time.time()
+        cpuParData = histogramParallel("/opt/data/hist_data.dat", mode=1, exponent = 10)
+        print('CPU_parallel_hist %d x %d time:  %.2E, parallel==CPU: %s' % (data.shape[0], data.shape[1], time.time() - start, np.all(cpuData == cpuParData)))
+
         histNaiveData, histNaiveRuntime = histNaive(data)
         gpu_Naive_array.append(histNaiveData)
         gpu_NaiveRuntime_array.append(histNaiveRuntime)
@@ -486,6 +1450,19 @@ if __name__=="__main__":
         gpu_Opt_array.append(histOptData)
         gpu_OptRuntime_array.append(histOptRuntime)
 
+        histStripData, histStripRuntime = histStrip(data)
+        print('GPU_strip %d x %d time:  %.2E, strip==CPU: %s' % (data.shape[0], data.shape[1], histStripRuntime, np.all(cpuData == histStripData)))
+
+        histPipeData, histPipeRuntime = histPipelined(data)
+        print('GPU_pipelined %d x %d time:  %.2E, pipelined==CPU: %s, overlap: %.2f' % (data.shape[0], data.shape[1], histPipeRuntime, np.all(cpuData == histPipeData), pipelineStats['overlap']))
+
+        histPrivData, histPrivRuntime = histByName('privatized', data)
+        print('GPU_privatized %d x %d time:  %.2E, privatized==CPU: %s' % (data.shape[0], data.shape[1], histPrivRuntime, np.all(cpuData == histPrivData)))
+        histCoarseData, histCoarseRuntime = histByName('coarsened', data)
+        print('GPU_coarsened %d x %d time:  %.2E, coarsened==CPU: %s' % (data.shape[0], data.shape[1], histCoarseRuntime, np.all(cpuData == histCoarseData)))
+        print('Speedup over Naive: opt %.2f, privatized %.2f, coarsened %.2f' % (histNaiveRuntime / histOptRuntime, histNaiveRuntime / histPrivRuntime, histNaiveRuntime / histCoarseRuntime))
+        print('Host<->device bytes: %s' % transferBytes)
+
         CustomHistEqual(cpuData, histNaiveData, histOptData)
         CustomPrintHistogram(histNaiveData[0:18])
         CustomPrintHistogram(histNaiveData[-18:])
@@ -504,6 +1481,14 @@ if __name__=="__main__":
         cpu_Runtime_array.append(cpuTime)
         print('CPU_hist %d x %d time:  %.2E' % (data.shape[0], data.shape[1], cpuTime))
 
+        start = time.time()
+        cpuVecData = histogramVectorized(data, exponent = 10)
+        print('CPU_vectorized_hist %d x %d time:  %.2E, vectorized==CPU: %s' % (data.shape[0], data.shape[1], time.time() - start, np.all(cpuData == cpuVecData)))
+
+        start = time.time()
+        cpuParData = histogramParallel("/opt/data/hist_data.dat", mode=2, exponent = 10)
+        print('CPU_parallel_hist %d x %d time:  %.2E, parallel==CPU: %s' % (data.shape[0], data.shape[1], time.time() - start, np.all(cpuData == cpuParData)))
+
         histNaiveData, histNaiveRuntime = histNaive(data)
         gpu_Naive_array.append(histNaiveData)
         gpu_NaiveRuntime_array.append(histNaiveRuntime)
@@ -512,11 +1497,28 @@ if __name__=="__main__":
         gpu_Opt_array.append(histOptData)
         gpu_OptRuntime_array.append(histOptRuntime)
 
+        histStripData, histStripRuntime = histStrip(data)
+        print('GPU_strip %d x %d time:  %.2E, strip==CPU: %s' % (data.shape[0], data.shape[1], histStripRuntime, np.all(cpuData == histStripData)))
+
+        histPipeData, histPipeRuntime = histPipelined(data)
+        print('GPU_pipelined %d x %d time:  %.2E, pipelined==CPU: %s, overlap: %.2f' % (data.shape[0], data.shape[1], histPipeRuntime, np.all(cpuData == histPipeData), pipelineStats['overlap']))
+
+        histPrivData, histPrivRuntime = histByName('privatized', data)
+        print('GPU_privatized %d x %d time:  %.2E, privatized==CPU: %s' % (data.shape[0], data.shape[1], histPrivRuntime, np.all(cpuData == histPrivData)))
+        histCoarseData, histCoarseRuntime = histByName('coarsened', data)
+        print('GPU_coarsened %d x %d time:  %.2E, coarsened==CPU: %s' % (data.shape[0], data.shape[1], histCoarseRuntime, np.all(cpuData == histCoarseData)))
+        print('Speedup over Naive: opt %.2f, privatized %.2f, coarsened %.2f' % (histNaiveRuntime / histOptRuntime, histNaiveRuntime / histPrivRuntime, histNaiveRuntime / histCoarseRuntime))
+        print('Host<->device bytes: %s' % transferBytes)
+
         CustomHistEqual(cpuData, histNaiveData, histOptData)
         CustomPrintHistogram(histNaiveData[0:18])
         CustomPrintHistogram(histNaiveData[-18:])
         CustomPrintHistogram(histOptData[0:18])
         CustomPrintHistogram(histOptData[-18:])
+
+        countType = saveHistogram("/opt/data/hist_data.hres", histOptData, data, exponent = 10)
+        stored = HistResultFile("/opt/data/hist_data.hres")
+        print('Stored %d x %d tiles as %s, last tile == Opt: %s' % (stored.rows, stored.cols, countType, np.all(stored.tile(stored.rows - 1, stored.cols - 1) == histOptData[-18:])))
     print("------------------------------------------------------")
 
     CustomPrintTime(cpu_Runtime_array, gpu_NaiveRuntime_array, gpu_OptRuntime_array)
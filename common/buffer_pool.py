@@ -0,0 +1,118 @@
+"""
+Device buffer pool
+    -> size-bucketed reuse of device allocations (pyopencl.tools.MemoryPool)
+    -> reuse statistics
+    -> cap on high-water device memory (EECS4750_CL_POOL_MAX_BYTES)
+
+Pass the pool as allocator= to cl.array.to_device/empty/zeros so repeated
+calls with the same shapes hand back the same device blocks.
+"""
+import os
+import threading
+
+import pyopencl as cl
+import pyopencl.tools
+
+MAX_BYTES_ENV = 'EECS4750_CL_POOL_MAX_BYTES'
+
+_lock = threading.Lock()
+_pools = {}
+
+
+class BufferPool(object):
+    """
+    Allocator callable for cl.array with reuse counters and a memory cap
+        -> one pyopencl MemoryPool per size bin, so whether a request can be
+           served from a held block is known before the driver is touched
+    Input:
+        variable queue: CommandQueue used by the underlying allocator
+        variable max_bytes: cap on active + held device bytes (None -> no cap)
+    """
+
+    def __init__(self, queue, max_bytes=None):
+        self.queue = queue
+        self.max_bytes = max_bytes
+        self._allocator = cl.tools.ImmediateAllocator(queue)
+        # Bin arithmetic only, never allocates
+        self._bins = cl.tools.MemoryPool(self._allocator)
+        self._pools = {}
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.reused = 0
+        self.high_water = 0
+
+    def __call__(self, nbytes):
+        return self.allocate(nbytes)
+
+    def _bytes(self, attr):
+        return sum(getattr(pool, attr) for pool in self._pools.values())
+
+    def _free_held(self):
+        for pool in self._pools.values():
+            pool.free_held()
+
+    def allocate(self, nbytes):
+        """
+        Allocate a pooled device buffer of at least nbytes
+        Input:
+            variable nbytes: requested size in bytes
+        Return/Output: PooledBuffer, returned to the pool when released
+        """
+        with self._lock:
+            binNumber = self._bins.bin_number(nbytes)
+            pool = self._pools.get(binNumber)
+            if pool is None:
+                pool = self._pools[binNumber] = cl.tools.MemoryPool(self._allocator)
+            reused = pool.held_blocks > 0
+
+            # Enforce the cap before new memory is taken: drop cached blocks
+            # of other bins first, then refuse
+            if not reused and self.max_bytes is not None:
+                bucket = self._bins.alloc_size(binNumber) if nbytes else 0
+                if self._bytes('managed_bytes') + bucket > self.max_bytes:
+                    self._free_held()
+                    if self._bytes('active_bytes') + bucket > self.max_bytes:
+                        raise MemoryError('BufferPool cap %d bytes exceeded: %d active, %d requested'
+                                          % (self.max_bytes, self._bytes('active_bytes'), nbytes))
+
+            buf = pool.allocate(nbytes)
+            self.requests += 1
+            if reused:
+                self.reused += 1
+            self.high_water = max(self.high_water, self._bytes('managed_bytes'))
+        return buf
+
+    def free_held(self):
+        """
+        Release all cached (inactive) blocks back to the driver
+        """
+        with self._lock:
+            self._free_held()
+
+    def stats(self):
+        """
+        Return/Output: dict of reuse counters and current/peak device bytes
+        """
+        with self._lock:
+            managed = self._bytes('managed_bytes')
+            active = self._bytes('active_bytes')
+            return {'requests': self.requests, 'reused': self.reused,
+                    'active_bytes': active, 'held_bytes': managed - active,
+                    'high_water_bytes': self.high_water, 'max_bytes': self.max_bytes}
+
+
+def get_pool(queue):
+    """
+    Return the process-wide pool for queue's context
+    Input:
+        variable queue: CommandQueue
+    Return/Output: BufferPool
+    """
+    key = queue.context.int_ptr
+    with _lock:
+        pool = _pools.get(key)
+        if pool is None:
+            max_bytes = os.environ.get(MAX_BYTES_ENV)
+            pool = BufferPool(queue, int(max_bytes) if max_bytes else None)
+            _pools[key] = pool
+    return pool
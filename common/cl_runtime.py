@@ -0,0 +1,173 @@
+"""
+Shared openCL runtime
+    -> platform/device selection (name or index, env var override)
+    -> one context and CommandQueue per device, created once per process
+    -> CPU device fallback (PoCL) when no GPU platform is present
+
+Selection order:
+    1. explicit platform/device arguments
+    2. EECS4750_CL_PLATFORM / EECS4750_CL_DEVICE environment variables
+    3. first GPU on a preferred platform (NVIDIA CUDA, Apple)
+    4. first GPU on any platform
+    5. first CPU device (PoCL or vendor CPU runtime)
+"""
+import os
+import threading
+
+import pyopencl as cl
+
+PLATFORM_ENV = 'EECS4750_CL_PLATFORM'
+DEVICE_ENV = 'EECS4750_CL_DEVICE'
+
+PREFERRED_PLATFORMS = ['NVIDIA CUDA', 'Apple']
+
+_lock = threading.RLock()
+_runtimes = {}
+
+
+class CLRuntime(object):
+    """
+    Context and named CommandQueues for a single device
+    Queues are created lazily and reused for the life of the process
+    """
+
+    def __init__(self, device):
+        self.device = device
+        self.ctx = cl.Context([device])
+        self._queues = {}
+        self.queue = self.get_queue()
+
+    def get_queue(self, name='default', out_of_order=False):
+        """
+        Return the CommandQueue registered under name, creating it on first use
+        Input:
+            variable name: queue key, extra names give independent in-order queues
+            variable out_of_order: request an out-of-order queue if supported
+        Return/Output: CommandQueue
+        """
+        key = (name, out_of_order)
+        with _lock:
+            queue = self._queues.get(key)
+            if queue is None:
+                # Command queue, enable GPU profiling
+                props = cl.command_queue_properties.PROFILING_ENABLE
+                if out_of_order and (self.device.queue_properties &
+                                     cl.command_queue_properties.OUT_OF_ORDER_EXEC_MODE_ENABLE):
+                    props |= cl.command_queue_properties.OUT_OF_ORDER_EXEC_MODE_ENABLE
+                queue = cl.CommandQueue(self.ctx, properties=props)
+                self._queues[key] = queue
+        return queue
+
+    @property
+    def key(self):
+        """
+        Identifier of the device/driver pair, stable across processes
+        """
+        return '%s|%s|%s' % (self.device.platform.name, self.device.name, self.device.driver_version)
+
+
+def _match(items, selector):
+    """
+    Pick an item by index or by case-insensitive name substring
+    Input:
+        variable items: list of platforms or devices
+        variable selector: int, digit string, or name substring
+    Return/Output: matching item or None
+    """
+    if selector is None:
+        return None
+    if isinstance(selector, int) or str(selector).isdigit():
+        idx = int(selector)
+        return items[idx] if idx < len(items) else None
+    for item in items:
+        if str(selector).lower() in item.name.lower():
+            return item
+    return None
+
+
+def select_device(platform=None, device=None):
+    """
+    Resolve the openCL device to run on
+    Input:
+        variable platform: platform name substring or index (None -> env/auto)
+        variable device: device name substring or index (None -> env/auto)
+    Return/Output: pyopencl Device
+    """
+    platform = platform if platform is not None else os.environ.get(PLATFORM_ENV)
+    device = device if device is not None else os.environ.get(DEVICE_ENV)
+
+    platforms = cl.get_platforms()
+    if not platforms:
+        raise RuntimeError('No openCL platforms found')
+
+    # Explicit selection
+    if platform is not None or device is not None:
+        if platform is not None:
+            candidates = [_match(platforms, platform)]
+            if candidates[0] is None:
+                raise RuntimeError('openCL platform %r not found in %s' % (platform, [p.name for p in platforms]))
+        else:
+            candidates = platforms
+        for p in candidates:
+            devices = p.get_devices()
+            if device is None:
+                return devices[0]
+            dev = _match(devices, device)
+            if dev is not None:
+                return dev
+        raise RuntimeError('openCL device %r not found' % device)
+
+    # Preferred GPU platforms, then any GPU, then CPU fallback
+    ordered = sorted(platforms, key=lambda p: p.name not in PREFERRED_PLATFORMS)
+    for dev_type in (cl.device_type.GPU, cl.device_type.ALL):
+        for p in ordered:
+            try:
+                devices = p.get_devices(device_type=dev_type)
+            except cl.Error:
+                continue
+            if devices:
+                return devices[0]
+    raise RuntimeError('No openCL devices found')
+
+
+def get_runtime(platform=None, device=None):
+    """
+    Return the process-wide runtime for the selected device
+    Input:
+        variable platform: platform name substring or index
+        variable device: device name substring or index
+    Return/Output: CLRuntime
+    """
+    platform = platform if platform is not None else os.environ.get(PLATFORM_ENV)
+    device = device if device is not None else os.environ.get(DEVICE_ENV)
+
+    # Fast path: same selector seen before, no platform enumeration
+    selector = (platform, device)
+    with _lock:
+        runtime = _runtimes.get(selector)
+    if runtime is not None:
+        return runtime
+
+    dev = select_device(platform, device)
+    with _lock:
+        # Different selectors resolving to one device share a runtime
+        for existing in _runtimes.values():
+            if existing.device == dev:
+                runtime = existing
+                break
+        if runtime is None:
+            runtime = CLRuntime(dev)
+        _runtimes[selector] = runtime
+    return runtime
+
+
+def setup_CL(platform=None, device=None):
+    """
+    Sets up openCL platform devices,
+        context, and CommandQueue
+    Cached: repeated calls return the same context and queue
+
+    Returns: list of device, context, CommandQueue
+    """
+    runtime = get_runtime(platform, device)
+    return [[runtime.device], runtime.ctx, runtime.queue]
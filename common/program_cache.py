@@ -0,0 +1,214 @@
+"""
+Compiled openCL program cache
+    -> in-memory LRU of built cl.Program objects (per context), with the
+       cl.Kernel objects retrieved from them (one per entry point)
+    -> on-disk tier of device binaries, survives process restarts
+Keyed on (platform, device, driver version, rendered source hash, build options)
+so any change to the generated kernel text or the driver forces a rebuild.
+
+The disk tier lives in EECS4750_CL_CACHE_DIR (default ~/.cache/eecs4750/cl),
+set EECS4750_CL_CACHE_DIR='' to disable it.
+"""
+import collections
+import hashlib
+import os
+import tempfile
+import threading
+
+import pyopencl as cl
+
+CACHE_DIR_ENV = 'EECS4750_CL_CACHE_DIR'
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'eecs4750', 'cl')
+
+
+class ProgramCache(object):
+    """
+    Two-tier cache of built programs
+    Input:
+        variable max_entries: size of the in-memory LRU tier
+        variable cache_dir: directory for binaries, None disables the disk tier
+    """
+
+    def __init__(self, max_entries=64, cache_dir=None):
+        self.max_entries = max_entries
+        self.cache_dir = cache_dir
+        self._programs = collections.OrderedDict()
+        self._kernels = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def key(self, device, source, options):
+        """
+        Digest identifying a (device, driver, source, options) build
+        """
+        h = hashlib.sha256()
+        for part in (device.platform.name, device.name, device.driver_version,
+                     ' '.join(options), source):
+            h.update(part.encode('utf-8'))
+            h.update(b'\0')
+        return h.hexdigest()
+
+    def build(self, ctx, source, options=None):
+        """
+        Return a built program for source, compiling only on a miss
+        Input:
+            variable ctx: openCL context (single device)
+            variable source: rendered kernel source
+            variable options: list of build options
+        Return/Output: cl.Program
+        """
+        return self._build(ctx, source, options)[1]
+
+    def kernel(self, ctx, source, options=None, name='func'):
+        """
+        Return the kernel name of the built program, created once per entry
+            -> prg.name hands back a new cl.Kernel on every access, cached
+               kernels keep that out of per-tile launch loops
+            -> a kernel holds its arguments: do not launch the same one from
+               several threads at once
+        Input:
+            variable ctx: openCL context (single device)
+            variable source: rendered kernel source
+            variable options: list of build options
+            variable name: kernel function name
+        Return/Output: cl.Kernel
+        """
+        mem_key, prg = self._build(ctx, source, options)
+        with self._lock:
+            knl = self._kernels.get((mem_key, name))
+            if knl is None:
+                knl = cl.Kernel(prg, name)
+                # Only while the program is still cached, eviction drops it
+                if mem_key in self._programs:
+                    self._kernels[(mem_key, name)] = knl
+        return knl
+
+    def _build(self, ctx, source, options):
+        options = [str(o) for o in (options or [])]
+        device = ctx.devices[0]
+        digest = self.key(device, source, options)
+        mem_key = (ctx.int_ptr, digest)
+
+        # Memory tier
+        with self._lock:
+            prg = self._programs.get(mem_key)
+            if prg is not None:
+                self._programs.move_to_end(mem_key)
+                self.hits += 1
+                return [mem_key, prg]
+
+        # Disk tier
+        prg = self._load_binary(ctx, device, digest, options)
+        if prg is not None:
+            with self._lock:
+                self.disk_hits += 1
+        else:
+            prg = cl.Program(ctx, source).build(options=options)
+            with self._lock:
+                self.misses += 1
+            self._store_binary(prg, digest)
+
+        with self._lock:
+            self._programs[mem_key] = prg
+            self._programs.move_to_end(mem_key)
+            while len(self._programs) > self.max_entries:
+                evicted = self._programs.popitem(last=False)[0]
+                for k in [k for k in self._kernels if k[0] == evicted]:
+                    del self._kernels[k]
+        return [mem_key, prg]
+
+    def _path(self, digest):
+        return os.path.join(self.cache_dir, digest + '.bin')
+
+    def _load_binary(self, ctx, device, digest, options):
+        if not self.cache_dir:
+            return None
+        path = self._path(digest)
+        try:
+            with open(path, 'rb') as f:
+                binary = f.read()
+            return cl.Program(ctx, [device], [binary]).build(options=options)
+        except (IOError, OSError, cl.Error):
+            # Missing or stale binary (driver upgrade) -> recompile from source
+            return None
+
+    def _store_binary(self, prg, digest):
+        if not self.cache_dir:
+            return
+        try:
+            binary = prg.get_info(cl.program_info.BINARIES)[0]
+            if not binary:
+                return
+            if not os.path.isdir(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            # Write then rename so concurrent jobs never read a partial file
+            fd, tmp = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(binary)
+            os.replace(tmp, self._path(digest))
+        except (IOError, OSError, cl.Error):
+            pass
+
+    def stats(self):
+        """
+        Return/Output: dict of hit/miss counters and entries held in memory
+        """
+        with self._lock:
+            return {'hits': self.hits, 'disk_hits': self.disk_hits,
+                    'misses': self.misses, 'entries': len(self._programs)}
+
+    def clear(self):
+        """
+        Drop the in-memory tier and reset counters, disk binaries are kept
+        """
+        with self._lock:
+            self._programs.clear()
+            self._kernels.clear()
+            self.hits = self.disk_hits = self.misses = 0
+
+
+_cache = ProgramCache(cache_dir=os.environ.get(CACHE_DIR_ENV, DEFAULT_CACHE_DIR) or None)
+
+
+def get_cache():
+    """
+    Return/Output: the process-wide ProgramCache
+    """
+    return _cache
+
+
+def define_options(**defines):
+    """
+    Turn compile-time constants into -D build options
+    Input:
+        variable defines: NAME=value pairs, sorted so the cache key is stable
+    Return/Output: list of build options
+    """
+    return ['-D%s=%s' % (name, int(value)) for name, value in sorted(defines.items())]
+
+
+def build_program(ctx, source, options=None):
+    """
+    Build (or fetch) a program through the process-wide cache
+    Input:
+        variable ctx: openCL context
+        variable source: rendered kernel source
+        variable options: list of build options
+    Return/Output: cl.Program
+    """
+    return _cache.build(ctx, source, options)
+
+
+def build_kernel(ctx, source, options=None, name='func'):
+    """
+    Build (or fetch) a program and its kernel through the process-wide cache
+    Input:
+        variable ctx: openCL context
+        variable source: rendered kernel source
+        variable options: list of build options
+        variable name: kernel function name
+    Return/Output: cl.Kernel
+    """
+    return _cache.kernel(ctx, source, options, name)